@@ -1,6 +1,26 @@
+from instrumentation import span
+
+
+class ApiError(Exception):
+    # Non-200 response from the data API; keeps the status and any Retry-After (seconds) for callers
+    # that back off on rate limiting and server errors
+    def __init__(self, message, status_code, retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status_code == 429 or self.status_code >= 500
+
+
 class ClearGuideApiHandler:
     import requests
 
+    # (connect, read) seconds; a stalled connection would otherwise hold a worker, and every session
+    # waiting on the same shared download, forever
+    timeout = (10, 120)
+
     def __init__(self, username, password):
         self.username = username
         self.password = password
@@ -10,7 +30,8 @@ class ClearGuideApiHandler:
 
     def authenticate(self):
         data = {"username": self.username, "password": self.password}
-        response = self.requests.post('https://auth.iteris-clearguide.com/api/token/', data=data)
+        with span('auth'):
+            response = self.requests.post('https://auth.iteris-clearguide.com/api/token/', data=data, timeout=self.timeout)
         if response.status_code == 200:
             response_dict = response.json()
             self.refresh_token = response_dict.get('refresh')
@@ -20,9 +41,10 @@ class ClearGuideApiHandler:
         raise Exception(
             f"Error while authenticating... Status Code: {response.status_code} Message: {response.text}")
 
-    def refresh_token(self):
+    def refresh_access_token(self):
+        # Not named refresh_token: that attribute holds the token itself and would shadow the method
         data = {"refresh": self.refresh_token}
-        response = self.requests.post('https://auth.iteris-clearguide.com/api/token/refresh/', data=data)
+        response = self.requests.post('https://auth.iteris-clearguide.com/api/token/refresh/', data=data, timeout=self.timeout)
         if response.status_code == 200:
             self.access_token = response.json().get('access')
         else:
@@ -32,16 +54,25 @@ class ClearGuideApiHandler:
     def auth_header(self):
         return {'Authorization': f'Bearer {self.access_token}'}
 
-    def call(self, url):
-        response = self.requests.get(url=url, headers=self.auth_header)
+    def call(self, url, reauthenticate=True):
+        # A 401 refreshes the token (or logs in again) and retries once; a second 401 is raised
+        with span('network') as record:
+            response = self.requests.get(url=url, headers=self.auth_header, timeout=self.timeout)
+            record['bytes'] = len(response.content)
         if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 401:
-            self.refresh_token()
-            return self.call(url)
+            with span('json_decode', bytes=len(response.content)):
+                return response.json()
+        elif response.status_code == 401 and reauthenticate:
+            self.refresh_access_token()
+            return self.call(url, reauthenticate=False)
         else:
-            raise Exception(
-                f"Error fetching response from ClearGuide... Status Code: {response.status_code} Message: {response.text}")
+            # Retry-After may also be an HTTP date; only the seconds form is used
+            retry_after = response.headers.get('Retry-After')
+            raise ApiError(
+                f"Error fetching response from ClearGuide... Status Code: {response.status_code} Message: {response.text}",
+                response.status_code,
+                float(retry_after) if retry_after and retry_after.strip().isdigit() else None
+            )
 
 
 if __name__ == '__main__':
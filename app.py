@@ -3,15 +3,24 @@
 # Import the necessary libraries
 import streamlit as st
 import pandas as pd
-import numpy as np
-import plotly.express as px
-import plotly.graph_objects as go
-import datetime
-from api.function import ClearGuideApiHandler
-from datetime import datetime, timezone
-import pytz
-from timeseries import timeseries_comparison, build_timeseries_plot, summary_table, process_time_of_day, build_time_of_day_plot
-from speed_contours import speed_comparison, process_speed_contours, build_heatmaps
+import os
+from concurrent.futures import ThreadPoolExecutor
+import config
+from timeseries import build_timeseries_plot, summary_statistics, summary_table, process_time_of_day, build_time_of_day_plot
+from speed_contours import process_speed_contours, build_heatmaps
+from data_store import SharedDataStore, day_cache_from_env
+from jobs import FetchJob
+from quantile_sketch import build_daily_sketches
+from dense import to_dense
+from instrumentation import collect, configure_logging, span, start_metrics_server
+
+
+# Load .env before anything reads its settings
+config.init()
+
+# Structured span logs, plus /metrics when METRICS_PORT is set
+configure_logging()
+start_metrics_server()
 
 
 # Set the title and favicon that appear in the Browser's tab bar.
@@ -93,24 +102,30 @@ with route_container:
 route_ids = [int(rid) for rid, _ in route_info] if route_info else []
 route_directions = {int(rid): direction for rid, direction in route_info}
 
-# Create two columns for the time windows
-col1, col2 = st.columns(2)
-
-with col1:
-    st.subheader("Window 1")
-    window1_start = st.date_input("Start Date (Window 1)")
-    window1_end = st.date_input("End Date (Window 1)")
-
-with col2:
-    st.subheader("Window 2")
-    window2_start = st.date_input("Start Date (Window 2)")
-    window2_end = st.date_input("End Date (Window 2)")
-
-# Combine dates and times into datetime strings
-window1_start_str = f"{window1_start} 00:00:00"
-window1_end_str = f"{window1_end} 23:59:59"
-window2_start_str = f"{window2_start} 00:00:00"
-window2_end_str = f"{window2_end} 23:59:59"
+# Time windows: a baseline plus one or more comparison periods
+st.subheader("Time Windows")
+num_windows = st.number_input("Number of windows", min_value=2, max_value=6, value=2, step=1)
+
+# Create a column for each time window
+windows = {}
+window_cols = st.columns(int(num_windows))
+for idx, window_col in enumerate(window_cols, start=1):
+    with window_col:
+        window_name = st.text_input(f"Name (Window {idx})", value=f"Window {idx}", key=f"window_name_{idx}").strip() or f"Window {idx}"
+        window_start = st.date_input(f"Start Date (Window {idx})", key=f"window_start_{idx}")
+        window_end = st.date_input(f"End Date (Window {idx})", key=f"window_end_{idx}")
+    # Combine dates and times into datetime strings
+    windows[window_name] = (f"{window_start} 00:00:00", f"{window_end} 23:59:59")
+
+duplicate_window_names = len(windows) < num_windows
+if duplicate_window_names:
+    st.warning("Window names must be unique.")
+
+baseline_window = st.selectbox(
+    "Baseline window",
+    list(windows),
+    help="Changes, p-values and heatmap differences are computed against this window."
+)
 
 # After the date selection and before the Fetch Data button
 st.subheader("KML File Upload")
@@ -120,63 +135,178 @@ uploaded_kml = st.file_uploader(
     help="The KML file is used to plot the intersections on the speed contour heatmaps."
 )
 
-# Move the cache function definition outside any button
-@st.cache_data
-def fetch_timeseries_data(route_ids, window1_start_str, window1_end_str, window2_start_str, window2_end_str, username, password):
-    return timeseries_comparison(
-        route_ids,
-        window1_start_str,
-        window1_end_str,
-        window2_start_str,
-        window2_end_str,
-        username,
-        password
+# Granularity of the full-resolution study data and of the quick preview shown while it downloads.
+# Speed contours are only ever plotted by hour, so they have no coarser preview.
+TIMESERIES_GRANULARITY = '5min'
+PREVIEW_TIMESERIES_GRANULARITY = 'hour'
+SPEED_GRANULARITY = 'hour'
+
+progressive_loading = st.checkbox(
+    "Progressive loading",
+    value=True,
+    help="Also fetch an hourly preview of the travel times, shown for each route until its 5-minute data and speed contours have downloaded."
+)
+
+@st.cache_resource
+def get_data_store():
+    # One store per server process, shared by every session. Cached frames are keyed on
+    # (endpoint, route, range, granularity) only; credentials are checked by the store separately.
+    # Settled past days are also read from the on-disk day cache that warmup.py fills off-peak.
+    return SharedDataStore(
+        max_bytes=int(os.getenv('DATA_STORE_MAX_MB', '1024')) * 1024 * 1024,
+        day_cache=day_cache_from_env()
+    )
+
+@st.cache_resource
+def get_background_executor():
+    # Shared by all sessions; each route of a fetch job occupies one worker while it downloads
+    return ThreadPoolExecutor(max_workers=int(os.getenv('FETCH_WORKERS', '8')), thread_name_prefix='fetch-job')
+
+@st.cache_resource
+def get_preview_executor():
+    # Hourly previews get their own small pool so they never queue behind other sessions' 5-minute downloads
+    return ThreadPoolExecutor(max_workers=int(os.getenv('PREVIEW_FETCH_WORKERS', '2')), thread_name_prefix='preview-job')
+
+def cancel_fetch_jobs():
+    for job in st.session_state.get('fetch_jobs', {}).values():
+        job.cancel()
+
+def fetch_jobs_running():
+    return any(not job.done() for job in st.session_state.get('fetch_jobs', {}).values())
+
+def landed_routes(jobs):
+    # (route_id, source) for every route with data so far, full resolution preferred over the preview
+    full, preview = jobs['full'], jobs.get('preview')
+    full_routes = set(full.completed_routes())
+    preview_routes = set(preview.completed_routes()) if preview is not None else set()
+    return tuple(
+        (route_id, 'full' if route_id in full_routes else 'preview')
+        for route_id in full.route_ids
+        if route_id in full_routes or route_id in preview_routes
     )
 
-@st.cache_data
-def fetch_speed_contours_data(route_ids, window1_start_str, window1_end_str, window2_start_str, window2_end_str, username, password):
-    return speed_comparison(
-        route_ids,
-        window1_start_str,
-        window1_end_str,
-        window2_start_str,
-        window2_end_str,
-        username,
-        password
+def sync_job_results():
+    # Assemble the study from the routes that have landed so far. The frames are only rebuilt when a
+    # route lands or is upgraded from the preview, so cached per-dataset work (sketches) is kept.
+    jobs = st.session_state.get('fetch_jobs')
+    if not jobs:
+        return
+    st.session_state.fetch_diagnostics = [record for job in jobs.values() for record in job.spans]
+
+    landed = landed_routes(jobs)
+    if landed == st.session_state.get('landed_routes'):
+        return
+    st.session_state.landed_routes = landed
+    if not landed:
+        st.session_state.pop('timeseries_data', None)
+        st.session_state.pop('speed_contours_data', None)
+        return
+
+    st.session_state.timeseries_data = pd.concat(
+        [jobs[source].results[route_id]['timeseries'] for route_id, source in landed],
+        ignore_index=True
     )
+    speed_frames = [jobs['full'].results[route_id]['speed_contours'] for route_id, source in landed if source == 'full']
+    st.session_state.speed_contours_data = pd.concat(speed_frames, ignore_index=True) if speed_frames else None
+    st.session_state.preview_routes = [route_id for route_id, source in landed if source == 'preview']
+
+
+def get_daily_sketches(timeseries_data):
+    # Rebuild only when a new dataset (fetch or newly landed route) replaces the current one
+    if st.session_state.get('daily_sketches_source') is not timeseries_data:
+        st.session_state.daily_sketches = build_daily_sketches(timeseries_data)
+        st.session_state.daily_sketches_source = timeseries_data
+    return st.session_state.daily_sketches
+
+def export_bundle_current(export_key):
+    # Whether the prepared export bundle was built from the same frames (by identity) and settings
+    cached_key = st.session_state.get('export_bundle_key')
+    return cached_key is not None and all(
+        cached is current if isinstance(current, pd.DataFrame) else cached == current
+        for cached, current in zip(cached_key, export_key)
+    )
+
+def get_dense_travel_times(timeseries_data):
+    # Regular 5-minute grid of the travel times, rebuilt like the sketches when the dataset changes.
+    # Laid out over the fetched windows so missing readings at their edges count as gaps.
+    if st.session_state.get('dense_travel_times_source') is not timeseries_data:
+        st.session_state.dense_travel_times = to_dense(timeseries_data, st.session_state.fetch_jobs['full'].windows, TIMESERIES_GRANULARITY)
+        st.session_state.dense_travel_times_source = timeseries_data
+    return st.session_state.dense_travel_times
+
+def get_time_of_day_profile(dense_travel_times, selected_days, excluded_dates):
+    # Dense time-of-day profile of every route, computed once per dataset and day filter and then
+    # sliced per route by process_time_of_day
+    profile_key = (tuple(selected_days), tuple(excluded_dates))
+    if (st.session_state.get('time_of_day_profile_source') is not dense_travel_times
+            or st.session_state.get('time_of_day_profile_key') != profile_key):
+        st.session_state.time_of_day_profile = dense_travel_times.time_of_day_profile(selected_days, excluded_dates)
+        st.session_state.time_of_day_profile_source = dense_travel_times
+        st.session_state.time_of_day_profile_key = profile_key
+    return st.session_state.time_of_day_profile
     
 
 # Split into two buttons
 if st.button("Fetch Data"):
     if not route_ids:
         st.warning("Please enter at least one Route ID")
+    elif duplicate_window_names:
+        st.warning("Please give each window a unique name")
     else:
-        try:
-            # Fetch and cache the data
-            st.info("Fetching data... Please wait.")
-            st.session_state.timeseries_data = fetch_timeseries_data(
-                route_ids,
-                window1_start_str,
-                window1_end_str,
-                window2_start_str,
-                window2_end_str,
-                username,
-                password
+        # A newer fetch supersedes any job still running for the previous one
+        cancel_fetch_jobs()
+        for key in ['fetch_jobs', 'landed_routes', 'timeseries_data', 'speed_contours_data', 'preview_routes']:
+            st.session_state.pop(key, None)
+
+        # Fetches run as background jobs, one worker per route, and each route is analysed as it lands
+        jobs = {}
+        if progressive_loading:
+            jobs['preview'] = FetchJob(
+                route_ids, windows, username, password,
+                {'timeseries': PREVIEW_TIMESERIES_GRANULARITY},
+                store=get_data_store()
+            ).start(get_preview_executor())
+        jobs['full'] = FetchJob(
+            route_ids, windows, username, password,
+            {'timeseries': TIMESERIES_GRANULARITY, 'speed_contours': SPEED_GRANULARITY},
+            store=get_data_store()
+        ).start(get_background_executor())
+        st.session_state.fetch_jobs = jobs
+        st.session_state.show_analysis = True
+
+sync_job_results()
+
+if fetch_jobs_running():
+    # Poll the jobs, showing progress per route and window, and rerun the whole app when a route lands
+    @st.fragment(run_every=1)
+    def fetch_progress():
+        jobs = st.session_state.fetch_jobs
+        if not fetch_jobs_running() or landed_routes(jobs) != st.session_state.get('landed_routes'):
+            st.rerun()
+
+        full, preview = jobs['full'], jobs.get('preview')
+        st.write(f"Fetching data... {full.progress():.0%}")
+        if preview is not None and not preview.done():
+            st.caption(f"Hourly preview: {len(preview.completed_routes())} of {len(preview.route_ids)} routes ready.")
+        for route_id in full.route_ids:
+            route_fraction, window_fractions = full.route_progress(route_id)
+            st.progress(
+                route_fraction,
+                text=f"Route {route_id}: " + ", ".join(f"{name} {fraction:.0%}" for name, fraction in window_fractions.items())
             )
 
-            st.session_state.speed_contours_data = fetch_speed_contours_data(
-                route_ids,
-                window1_start_str,
-                window1_end_str,
-                window2_start_str,
-                window2_end_str,
-                username,
-                password
-            )
+        if st.button("Cancel fetch"):
+            cancel_fetch_jobs()
+            st.rerun()
 
-            st.success("Data fetched successfully!")
-        except Exception as e:
-            st.error(f"An error occurred: {str(e)}")
+    fetch_progress()
+
+if 'fetch_jobs' in st.session_state and not fetch_jobs_running():
+    full = st.session_state.fetch_jobs['full']
+    for route_id, message in full.errors.items():
+        st.error(f"An error occurred while fetching route {route_id}: {message}")
+    if full.cancelled:
+        st.warning(f"Fetch cancelled. Showing the {len(st.session_state.get('landed_routes', ()))} of {len(full.route_ids)} routes that had landed.")
 
 # Only show filters if data exists
 if 'timeseries_data' in st.session_state:
@@ -213,83 +343,231 @@ else:
 # Only show analyze button if data exists
 if 'timeseries_data' in st.session_state:
     if st.button("Analyze Data"):
-        try:
-            # Display the summary table
-            st.subheader("Summary Statistics")
-            # Get the summary table from cached data
-            summary_df = summary_table(st.session_state.timeseries_data, selected_days=selected_days, excluded_dates=excluded_dates)
-            # Format numbers: integers with no decimals, floats with 2 decimal places
-            st.dataframe(
-                summary_df.style
-                    .format({
-                        col: '{:.0f}' if summary_df[col].dtype == 'int64' else '{:.2f}'
-                        for col in summary_df.select_dtypes(include=['float64', 'int64']).columns
-                    })
-                    .applymap(lambda x: 'background-color: #90EE90' if isinstance(x, (int, float)) and x < 0 else '')
-                    ,
-                use_container_width=True
-            )
+        st.session_state.show_analysis = True
+    # Keep the analysis on screen across reruns so routes can be added (or upgraded from the preview) as they land
+    if st.session_state.get('show_analysis'):
+        with collect() as analysis_spans:
+            try:
+                # Display the summary table
+                st.subheader("Summary Statistics")
+                if st.session_state.get('preview_routes'):
+                    preview_list = ', '.join(str(route_id) for route_id in st.session_state.preview_routes)
+                    st.caption(f"Preview: routes {preview_list} use hourly travel times until their 5-minute data arrives.")
+                # Compare against the chosen baseline, falling back to the first fetched window if it was renamed since
+                fetched_windows = list(dict.fromkeys(st.session_state.timeseries_data['period']))
+                baseline = baseline_window if baseline_window in fetched_windows else fetched_windows[0]
+                comparison_windows = [window for window in fetched_windows if window != baseline]
+
+                # Get the summary table from cached data
+                summary_long = summary_statistics(st.session_state.timeseries_data, selected_days=selected_days, excluded_dates=excluded_dates, baseline=baseline)
+                summary_df = summary_table(st.session_state.timeseries_data, selected_days=selected_days, excluded_dates=excluded_dates, baseline=baseline, summary=summary_long)
+                # Format numbers: integers with no decimals, floats with 2 decimal places
+                st.dataframe(
+                    summary_df.style
+                        .format({
+                            col: '{:.0f}' if summary_df[col].dtype == 'int64' else '{:.2f}'
+                            for col in summary_df.select_dtypes(include=['float64', 'int64']).columns
+                        })
+                        .applymap(lambda x: 'background-color: #90EE90' if isinstance(x, (int, float)) and x < 0 else '')
+                        ,
+                    use_container_width=True
+                )
+                st.caption(
+                    "P-values treat every sample as independent. Confidence intervals come from a day-block bootstrap "
+                    "that resamples whole days, so they account for travel times being correlated within a day."
+                )
+
+                # Missing 5-minute readings per route and window (preview routes are hourly, so left out)
+                dense_travel_times = get_dense_travel_times(st.session_state.timeseries_data)
+                gap_stats = dense_travel_times.gap_statistics()
+                gap_stats = gap_stats[~gap_stats['route_id'].isin(st.session_state.get('preview_routes', []))]
+                with st.expander("Data gaps"):
+                    st.dataframe(
+                        gap_stats.rename(columns={
+                            'route_id': 'Route ID',
+                            'period': 'Window',
+                            'expected_slots': 'Expected Readings',
+                            'missing_slots': 'Missing Readings',
+                            'missing_pct': '% Missing',
+                            'longest_gap_minutes': 'Longest Gap (Minutes)',
+                        }).style.format({'% Missing': '{:.1f}', 'Longest Gap (Minutes)': '{:.0f}'}),
+                        use_container_width=True
+                    )
 
-            # Create columns for each route ID
-            num_routes = len(route_ids)
-            plot_cols = st.columns(num_routes)
-
-            # Display time of day plots for each route
-            #st.subheader("Time of Day Comparison by Route")
-            for idx, route_id in enumerate(route_ids):
-                with plot_cols[idx]:
-                    st.write(f"Route {route_id} - {route_directions[route_id]}")
-                    filtered_data = st.session_state.timeseries_data[
-                        st.session_state.timeseries_data['route_id'] == route_id
-                    ]
-                    processed_data = process_time_of_day(filtered_data, selected_days=selected_days, excluded_dates=excluded_dates)
+                # Create columns for each route ID
+                num_routes = len(route_ids)
+                plot_cols = st.columns(num_routes)
+
+                # Routes still downloading get a placeholder until their data lands
+                ready_routes = {route_id for route_id, _ in st.session_state.landed_routes}
+                full_resolution_routes = {route_id for route_id, source in st.session_state.landed_routes if source == 'full'}
+
+                # Daily quantile sketches are built once per dataset and merged for each day filter
+                daily_sketches = get_daily_sketches(st.session_state.timeseries_data)
+                time_of_day_profile = get_time_of_day_profile(dense_travel_times, selected_days, excluded_dates)
+
+                # Results gathered while plotting, for the export below (pyarrow is loaded on first analysis)
+                from export import contour_diff_frame, export_bundle, write_study
+                time_of_day_frames = []
+                contour_diff_frames = []
+
+                # Display time of day plots for each route
+                #st.subheader("Time of Day Comparison by Route")
+                for idx, route_id in enumerate(route_ids):
+                    with plot_cols[idx]:
+                        st.write(f"Route {route_id} - {route_directions[route_id]}")
+                        if route_id not in ready_routes:
+                            st.info("Travel times are still loading...")
+                            continue
+                        filtered_data = st.session_state.timeseries_data[
+                            st.session_state.timeseries_data['route_id'] == route_id
+                        ]
+                        processed_data = process_time_of_day(filtered_data, selected_days=selected_days, excluded_dates=excluded_dates, sketches=daily_sketches, profile=time_of_day_profile)
+                        time_of_day_frames.append(processed_data)
                     
-                    # Added unique key for time of day plot
-                    st.plotly_chart(
-                        build_time_of_day_plot(processed_data),
-                        use_container_width=True,
-                        key=f"tod_plot_{route_id}"  # Added unique key
+                        # Added unique key for time of day plot
+                        fig = build_time_of_day_plot(processed_data, baseline=baseline)
+                        with span('render_time_of_day_plot'):
+                            st.plotly_chart(
+                                fig,
+                                use_container_width=True,
+                                key=f"tod_plot_{route_id}"  # Added unique key
+                            )
+
+                # Display time series plots for each route
+                #st.subheader("Time Series Comparison by Route")
+                for idx, route_id in enumerate(route_ids):
+                    with plot_cols[idx]:
+                        st.write(f"Route {route_id} - {route_directions[route_id]}")
+                        if route_id not in ready_routes:
+                            st.info("Travel times are still loading...")
+                            continue
+                        filtered_data = st.session_state.timeseries_data[
+                            st.session_state.timeseries_data['route_id'] == route_id
+                        ]
+                        # Added unique key for time series plot
+                        fig = build_timeseries_plot(filtered_data, selected_days=selected_days, excluded_dates=excluded_dates)
+                        with span('render_timeseries_plot'):
+                            st.plotly_chart(
+                                fig,
+                                use_container_width=True,
+                                key=f"ts_plot_{route_id}"  # Added unique key
+                            )
+
+                # Display speed contours heatmaps
+                for idx, route_id in enumerate(route_ids):
+                    with plot_cols[idx]:
+                        st.write(f"Route {route_id} - {route_directions[route_id]}")
+                        if route_id not in full_resolution_routes:
+                            st.info("Speed contours are still loading...")
+                            continue
+                        filtered_data = st.session_state.speed_contours_data[
+                            st.session_state.speed_contours_data['route_id'] == route_id
+                        ]
+
+                        if uploaded_kml is None:
+                            st.warning("Please upload a KML file to view the heatmap")
+
+                        # One heatmap per comparison window, each diffed against the baseline
+                        for window in comparison_windows:
+                            processed_data = process_speed_contours(filtered_data, selected_days=selected_days, excluded_dates=excluded_dates, baseline=baseline, comparison=window)
+                            contour_diff_frames.append(contour_diff_frame(processed_data, route_id, baseline, window))
+
+                            if uploaded_kml is None:
+                                continue
+
+                            # Reset the file pointer to the beginning
+                            uploaded_kml.seek(0)
+                            fig = build_heatmaps(
+                                processed_data,
+                                uploaded_kml,
+                                route_directions[route_id],
+                                title=f"Speed Difference Heatmap - {route_directions[route_id]} ({window} vs {baseline})"
+                            )
+                            with span('render_heatmap'):
+                                st.plotly_chart(
+                                    fig,
+                                    use_container_width=True,
+                                    key=f"heatmap_{route_id}_{window}"
+                                )
+
+                # Export the study results for GIS and reporting tools. The export schemas have no
+                # granularity column, so hourly preview rows must never be mixed into them.
+                st.subheader("Export")
+                if st.session_state.get('preview_routes'):
+                    st.info("Export is available once every route has its 5-minute data.")
+                else:
+                    export_tables = {
+                        'timeseries': st.session_state.timeseries_data,
+                        'summary': summary_long,
+                        'time_of_day': pd.concat(time_of_day_frames, ignore_index=True),
+                    }
+                    if st.session_state.get('speed_contours_data') is not None:
+                        export_tables['speed_contours'] = st.session_state.speed_contours_data
+                        if contour_diff_frames:
+                            export_tables['contour_diffs'] = pd.concat(contour_diff_frames, ignore_index=True)
+
+                    export_format = st.radio(
+                        "Export format",
+                        ['parquet', 'arrow'],
+                        format_func=lambda file_format: {'parquet': 'Parquet', 'arrow': 'Arrow IPC (memory-mappable)'}[file_format],
+                        horizontal=True
                     )
-
-            # Display time series plots for each route
-            #st.subheader("Time Series Comparison by Route")
-            for idx, route_id in enumerate(route_ids):
-                with plot_cols[idx]:
-                    st.write(f"Route {route_id} - {route_directions[route_id]}")
-                    filtered_data = st.session_state.timeseries_data[
-                        st.session_state.timeseries_data['route_id'] == route_id
-                    ]
-                    # Added unique key for time series plot
-                    st.plotly_chart(
-                        build_timeseries_plot(filtered_data, selected_days=selected_days, excluded_dates=excluded_dates),
-                        use_container_width=True,
-                        key=f"ts_plot_{route_id}"  # Added unique key
+                    # Serializing every table is slow, so the bundle is only built on request and kept
+                    # until the dataset, filters, baseline or format change
+                    export_key = (
+                        st.session_state.timeseries_data,
+                        st.session_state.get('speed_contours_data'),
+                        tuple(selected_days),
+                        tuple(excluded_dates),
+                        baseline,
+                        export_format,
                     )
-
-            # Display speed contours heatmaps
-            for idx, route_id in enumerate(route_ids):
-                with plot_cols[idx]:
-                    st.write(f"Route {route_id} - {route_directions[route_id]}")
-                    filtered_data = st.session_state.speed_contours_data[
-                        st.session_state.speed_contours_data['route_id'] == route_id
-                    ]
-
-                    processed_data = process_speed_contours(filtered_data, selected_days=selected_days, excluded_dates=excluded_dates)
-
-                    if uploaded_kml is None:
-                        st.warning("Please upload a KML file to view the heatmap")
-                    else:
-                        # Reset the file pointer to the beginning
-                        uploaded_kml.seek(0)
-                        st.plotly_chart(
-                            build_heatmaps(processed_data, uploaded_kml, route_directions[route_id]),
-                            use_container_width=True,
-                            key=f"heatmap_{route_id}"
+                    if st.button("Prepare export"):
+                        with span('export_bundle') as record:
+                            st.session_state.export_bundle = export_bundle(export_tables, export_format)
+                            record['bytes'] = len(st.session_state.export_bundle)
+                        st.session_state.export_bundle_key = export_key
+                    if export_bundle_current(export_key):
+                        st.download_button(
+                            "Download study results",
+                            data=st.session_state.export_bundle,
+                            file_name=f"travel_time_study_{export_format}.zip",
+                            mime="application/zip"
                         )
 
-            
-
-            
-        except Exception as e:
-            st.error(f"An error occurred during analysis: {str(e)}")
-
+                    # Optionally write straight to a directory other processes read from
+                    export_dir = os.getenv('EXPORT_DIR')
+                    if export_dir and st.button(f"Write to {export_dir}"):
+                        paths = write_study(export_dir, export_tables, export_format)
+                        st.success(f"Wrote {len(paths)} files to {export_dir}")
+
+            except Exception as e:
+                st.error(f"An error occurred during analysis: {str(e)}")
+        st.session_state.analysis_diagnostics = list(analysis_spans)
+
+# Diagnostics panel ------------------------------------------------------
+if 'fetch_diagnostics' in st.session_state or 'analysis_diagnostics' in st.session_state:
+    with st.expander("Diagnostics"):
+        st.caption("Timing and payload per stage for the most recent fetch and analysis. Indented names are nested spans.")
+        store_stats = get_data_store().stats()
+        st.caption(
+            f"Shared data store: {store_stats['entries']} cached ranges, "
+            f"{store_stats['bytes'] / 1024 / 1024:.1f} of {store_stats['max_bytes'] / 1024 / 1024:.0f} MB, "
+            f"{store_stats['in_flight']} downloads in flight."
+        )
+        for label, key in [("Fetch", 'fetch_diagnostics'), ("Analysis", 'analysis_diagnostics')]:
+            if st.session_state.get(key):
+                st.write(label)
+                diagnostics_df = pd.DataFrame(st.session_state[key])
+                diagnostics_df['name'] = diagnostics_df['depth'].map(lambda depth: '  ' * depth) + diagnostics_df['name']
+                st.dataframe(
+                    diagnostics_df.groupby('name', sort=False).agg(
+                        calls=('duration_s', 'size'),
+                        seconds=('duration_s', 'sum'),
+                        bytes=('bytes', 'sum'),
+                        rows=('rows', 'sum'),
+                        cache=('cache', lambda values: ', '.join(sorted(set(values.dropna()))))
+                    ).reset_index(),
+                    use_container_width=True
+                )
@@ -0,0 +1,119 @@
+# Import-time benchmark for the modules loaded by app.py and worker processes.
+# Each module is imported in a fresh interpreter (best of --repeat runs). The run fails if a module
+# pulls in a dependency that should only load on first use, or if it takes longer than the budget.
+# Entry point scripts such as app.py cannot be imported outside Streamlit, so their module-level
+# imports are read from the source instead: a lazy dependency imported directly fails, and the
+# repo modules they import are timed and checked together.
+#
+# Usage: python benchmarks/import_time.py [--repeat 5] [--budget 1.5]
+
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = [
+    'config',
+    'instrumentation',
+    'fetch_planner',
+    'data_store',
+    'warmup',
+    'bootstrap',
+    'quantile_sketch',
+    'timeseries',
+    'speed_contours',
+    'jobs',
+    'dense',
+]
+
+ENTRY_POINTS = ['app.py']
+
+# Must not be imported as a side effect of importing any module above. Recent pandas loads core
+# pyarrow itself when it is installed, so the export layer is tracked through pyarrow.parquet.
+LAZY_DEPENDENCIES = ['scipy', 'geopy', 'lxml', 'plotly.express', 'pyarrow.parquet', 'dotenv']
+
+SNIPPET = '''
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'seconds': elapsed, 'loaded': [dep for dep in {lazy!r} if dep in sys.modules]}}))
+'''
+
+
+def measure(module, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-c', SNIPPET.format(module=module, lazy=LAZY_DEPENDENCIES)],
+            cwd=REPO_ROOT, capture_output=True, text=True, check=True
+        ).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(run['seconds'] for run in runs), runs[0]['loaded']
+
+
+def top_level_imports(path):
+    # Modules imported by statements directly in the module body (not inside functions or blocks)
+    with open(os.path.join(REPO_ROOT, path)) as f:
+        tree = ast.parse(f.read(), filename=path)
+    names = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            # `from plotly import express` imports plotly.express
+            names.append(node.module)
+            names.extend(f'{node.module}.{alias.name}' for alias in node.names)
+    return names
+
+def is_lazy(name):
+    return any(name == dep or name.startswith(f'{dep}.') for dep in LAZY_DEPENDENCIES)
+
+def is_repo_module(name):
+    top = name.split('.')[0]
+    return os.path.exists(os.path.join(REPO_ROOT, f'{top}.py')) or os.path.isdir(os.path.join(REPO_ROOT, top))
+
+def check_entry_point(path, repeat):
+    # (seconds to import its repo modules together, lazy dependencies loaded directly or through them)
+    names = top_level_imports(path)
+    direct = sorted({name for name in names if is_lazy(name)})
+    repo_modules = list(dict.fromkeys(name.split('.')[0] for name in names if is_repo_module(name)))
+    seconds, loaded = measure(', '.join(repo_modules), repeat) if repo_modules else (0.0, [])
+    return seconds, sorted(set(direct) | set(loaded))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=1.5, help='Maximum seconds per module import')
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'module':<20}{'seconds':>10}  eagerly loaded")
+    for module in MODULES:
+        seconds, loaded = measure(module, args.repeat)
+        print(f"{module:<20}{seconds:>10.3f}  {', '.join(loaded) or '-'}")
+        if loaded:
+            failures.append(f"{module} imports {', '.join(loaded)} at import time")
+        if seconds > args.budget:
+            failures.append(f"{module} took {seconds:.3f}s to import (budget {args.budget}s)")
+
+    for path in ENTRY_POINTS:
+        seconds, loaded = check_entry_point(path, args.repeat)
+        print(f"{path:<20}{seconds:>10.3f}  {', '.join(loaded) or '-'}")
+        if loaded:
+            failures.append(f"{path} imports {', '.join(loaded)} at module level")
+        if seconds > args.budget:
+            failures.append(f"{path} took {seconds:.3f}s to import its modules (budget {args.budget}s)")
+
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+# Day-block bootstrap for the change in mean travel time between windows.
+# Travel times within a day are strongly autocorrelated, so individual 5-minute samples are not
+# independent. Resampling whole days keeps that dependence intact: each replicate draws days with
+# replacement per route and window, and the replicate mean is the pooled sum over the pooled count of
+# the drawn days. Per-day sums and counts are computed once, so each replicate is just index arithmetic.
+
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Replicates drawn per batch; bounds the (replicates, groups, days) index array held in memory
+BATCH_SIZE = 500
+
+
+# Functions -----------------------------------------------------------------
+#-------------------------------------------------------------------------
+def day_aggregates(combined_data):
+    # Sum and count of travel times per route, window and local date
+    dates = combined_data['date'] if 'date' in combined_data else pd.to_datetime(combined_data['timestamp']).dt.strftime('%Y-%m-%d')
+    return (
+        combined_data.assign(date=dates)
+        .groupby(['route_id', 'period', 'date'])['travel_time']
+        .agg(['sum', 'count'])
+        .reset_index()
+    )
+
+def _pad_groups(aggregates):
+    # Lay each (route, window) group's days out as a row of a (groups, max_days) matrix, zero padded
+    groups = aggregates.groupby(['route_id', 'period'], sort=False)
+    sizes = groups.size()
+    keys = list(sizes.index)
+    n_days = sizes.to_numpy()
+    position = groups.cumcount().to_numpy()
+    group_index = groups.ngroup().to_numpy()
+
+    sums = np.zeros((len(keys), n_days.max()))
+    counts = np.zeros((len(keys), n_days.max()))
+    sums[group_index, position] = aggregates['sum'].to_numpy()
+    counts[group_index, position] = aggregates['count'].to_numpy()
+    return keys, sums, counts, n_days
+
+def _replicate_means(sums, counts, n_days, n_replicates, seed):
+    # Mean travel time of every group for n_replicates day resamples, shape (n_replicates, groups)
+    rng = np.random.default_rng(seed)
+    n_groups, max_days = sums.shape
+    in_group = np.arange(max_days)[None, :] < n_days[:, None]
+    rows = np.arange(n_groups)[None, :, None]
+
+    means = np.empty((n_replicates, n_groups))
+    for start in range(0, n_replicates, BATCH_SIZE):
+        batch = min(BATCH_SIZE, n_replicates - start)
+        # Day indices drawn uniformly from each group's own days; padded slots are masked out
+        picks = (rng.random((batch, n_groups, max_days)) * n_days[None, :, None]).astype(np.int64)
+        total = (sums[rows, picks] * in_group).sum(axis=2)
+        count = (counts[rows, picks] * in_group).sum(axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[start:start + batch] = total / count
+    return means
+
+def day_block_bootstrap(combined_data, baseline=None, n_replicates=2000, confidence=0.95, seed=None, n_jobs=1):
+    # Confidence intervals for the change in mean travel time (and percent change) of every window
+    # against the baseline, for every route at once. n_jobs > 1 splits the replicates across a
+    # process pool, each worker with an independent random stream.
+    periods = list(dict.fromkeys(combined_data['period']))
+    baseline = baseline or periods[0]
+
+    empty = pd.DataFrame({
+        'route_id': pd.Series(dtype='int64'),
+        'period': pd.Series(dtype='object'),
+        **{column: pd.Series(dtype='float64') for column in ['diff_ci_low', 'diff_ci_high', 'pct_change_ci_low', 'pct_change_ci_high']},
+    })
+    aggregates = day_aggregates(combined_data)
+    if aggregates.empty:
+        # e.g. the day filters left no days
+        return empty
+
+    keys, sums, counts, n_days = _pad_groups(aggregates)
+
+    if n_jobs > 1:
+        seeds = np.random.SeedSequence(seed).spawn(n_jobs)
+        chunks = [len(chunk) for chunk in np.array_split(np.arange(n_replicates), n_jobs)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            means = np.vstack(list(pool.map(
+                _replicate_means,
+                [sums] * n_jobs, [counts] * n_jobs, [n_days] * n_jobs, chunks, seeds
+            )))
+    else:
+        means = _replicate_means(sums, counts, n_days, n_replicates, seed)
+
+    # Pair every comparison group with its route's baseline group
+    group_of = {key: idx for idx, key in enumerate(keys)}
+    pairs = [
+        (route_id, period, group_of[(route_id, baseline)], idx)
+        for idx, (route_id, period) in enumerate(keys)
+        if period != baseline and (route_id, baseline) in group_of
+    ]
+    if not pairs:
+        return empty
+
+    baseline_idx = np.array([pair[2] for pair in pairs])
+    comparison_idx = np.array([pair[3] for pair in pairs])
+    diff = means[:, comparison_idx] - means[:, baseline_idx]
+    pct_change = diff / means[:, baseline_idx] * 100
+
+    tail = (1 - confidence) / 2 * 100
+    diff_low, diff_high = np.nanpercentile(diff, [tail, 100 - tail], axis=0)
+    pct_low, pct_high = np.nanpercentile(pct_change, [tail, 100 - tail], axis=0)
+
+    return pd.DataFrame({
+        'route_id': [pair[0] for pair in pairs],
+        'period': [pair[1] for pair in pairs],
+        'diff_ci_low': diff_low,
+        'diff_ci_high': diff_high,
+        'pct_change_ci_low': pct_low,
+        'pct_change_ci_high': pct_high,
+    })
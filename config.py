@@ -0,0 +1,14 @@
+# Explicit configuration step for the app and worker processes.
+# Importing the analysis modules has no side effects; entry points call init() once at startup so
+# settings in .env (credentials, METRICS_PORT, DATA_STORE_MAX_MB, EXPORT_DIR, ...) reach os.environ.
+
+_initialized = False
+
+
+def init(dotenv_path=None):
+    global _initialized
+    if _initialized:
+        return
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path)
+    _initialized = True
@@ -0,0 +1,280 @@
+# Process-wide store for parsed API responses, shared by every session.
+# Entries are keyed only on what was requested (endpoint, route, range, granularity) so two analysts
+# looking at the same corridor share one download. Credentials are checked separately by authorize()
+# and never become part of a cache key.
+#
+# Behind the in-memory store sits an optional DayCache on disk, partitioned by local day, which the
+# warm-up daemon (warmup.py) fills off-peak so interactive requests for past days skip the API. A
+# request that is only partly cached fetches just the days that are missing.
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
+import pandas as pd
+
+from api.function import ClearGuideApiHandler
+from fetch_planner import LOCAL_TZ, TIMESTAMP_FORMAT, to_utc
+from instrumentation import annotate
+
+
+# ClearGuide has finished loading a day once it is this many days old (yesterday is 1 day old). A day
+# fetched after that is cached for good; one fetched earlier may still be filling in, so it is only
+# reused for RECENT_TTL_HOURS and then fetched again.
+SETTLE_DAYS = 2
+RECENT_TTL_HOURS = 6
+
+# How often save() checks the cache directory against its size and age limits
+PRUNE_INTERVAL_SECONDS = 300
+
+
+class DayCache:
+    # Parsed frames saved as one Parquet file per (endpoint, granularity, route, local date).
+    # Every past day with data is saved; the file's modification time is its fetch time, which decides
+    # whether the day had settled when it was fetched. The directory is held under max_bytes and
+    # max_age_days (None for no limit) by deleting the files fetched longest ago.
+
+    def __init__(self, directory, settle_days=SETTLE_DAYS, max_bytes=None, max_age_days=None, recent_ttl_hours=RECENT_TTL_HOURS):
+        self.directory = directory
+        self.settle_days = max(1, settle_days)
+        self.recent_ttl_hours = recent_ttl_hours
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self._last_prune = 0.0
+
+    def _path(self, endpoint, granularity, route_id, date):
+        # Endpoint URLs end in a readable name, e.g. .../route/timeseries/ -> timeseries
+        endpoint_name = endpoint.rstrip('/').split('/')[-1]
+        return os.path.join(self.directory, endpoint_name, granularity, str(route_id), f'{date}.parquet')
+
+    @staticmethod
+    def _local_days(start_utc, end_utc):
+        # The local dates a UTC range covers completely, or None if it does not start at local midnight
+        # and end at 23:59:59 (the only ranges the fetch planner produces from date windows)
+        start = datetime.strptime(start_utc, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ)
+        end = datetime.strptime(end_utc, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc).astimezone(LOCAL_TZ)
+        if start.strftime('%H:%M:%S') != '00:00:00' or end.strftime('%H:%M:%S') != '23:59:59':
+            return None
+        return [str(day.date()) for day in pd.date_range(start.date(), end.date(), freq='D')]
+
+    def has_day(self, endpoint, granularity, route_id, date):
+        # Cached and within the age limit, and either fetched once the day had settled or fetched
+        # within the last recent_ttl_hours
+        try:
+            fetched_at = os.path.getmtime(self._path(endpoint, granularity, route_id, date))
+        except FileNotFoundError:
+            return False
+        if self.max_age_days is not None and time.time() - fetched_at > self.max_age_days * 86400:
+            return False
+        fetched_date = datetime.fromtimestamp(fetched_at, LOCAL_TZ).date()
+        if (fetched_date - datetime.strptime(date, '%Y-%m-%d').date()).days >= self.settle_days:
+            return True
+        return time.time() - fetched_at < self.recent_ttl_hours * 3600
+
+    def plan(self, key):
+        # Split the range of key into consecutive (start_utc, end_utc, data) segments in date order:
+        # data is the cached frame for a cached day, or None for a run of uncached days to fetch.
+        # A range that does not cover whole local days is one segment to fetch.
+        endpoint, route_id, start_utc, end_utc, granularity = key
+        days = self._local_days(start_utc, end_utc)
+        if not days:
+            return [(start_utc, end_utc, None)]
+
+        segments = []
+        for day in days:
+            data = None
+            if self.has_day(endpoint, granularity, route_id, day):
+                try:
+                    data = pd.read_parquet(self._path(endpoint, granularity, route_id, day))
+                except FileNotFoundError:
+                    # Pruned since has_day looked
+                    pass
+            day_end = to_utc(f'{day} 23:59:59').strftime(TIMESTAMP_FORMAT)
+            if data is None and segments and segments[-1][2] is None:
+                segments[-1] = (segments[-1][0], day_end, None)
+            else:
+                segments.append((to_utc(f'{day} 00:00:00').strftime(TIMESTAMP_FORMAT), day_end, data))
+        return segments
+
+    def save(self, key, data):
+        endpoint, route_id, start_utc, end_utc, granularity = key
+        days = self._local_days(start_utc, end_utc)
+        if not days:
+            return
+        today = str(datetime.now(LOCAL_TZ).date())
+        data_by_day = dict(tuple(data.groupby(data['timestamp'].str[:10])))
+        for day in days:
+            # Today is still in progress. A day with no rows may just not be loaded yet (or a route
+            # outage), so it is never saved either.
+            if day >= today or day not in data_by_day:
+                continue
+            path = self._path(endpoint, granularity, route_id, day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so concurrent readers never see a partial file
+            temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            data_by_day[day].reset_index(drop=True).to_parquet(temp_path, index=False)
+            os.replace(temp_path, path)
+
+        if time.monotonic() - self._last_prune > PRUNE_INTERVAL_SECONDS:
+            self.prune()
+
+    def prune(self):
+        # Delete the files fetched longest ago until the directory is within max_bytes, and every file
+        # fetched more than max_age_days ago. Returns the number of files deleted.
+        self._last_prune = time.monotonic()
+        if self.max_bytes is None and self.max_age_days is None:
+            return 0
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.parquet'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in files)
+        oldest_allowed = time.time() - self.max_age_days * 86400 if self.max_age_days is not None else None
+        deleted = 0
+        for fetched_at, size, path in sorted(files):
+            too_old = oldest_allowed is not None and fetched_at < oldest_allowed
+            too_big = self.max_bytes is not None and total_bytes > self.max_bytes
+            if not too_old and not too_big:
+                # Files are in fetch order, so every later one is newer and the total only shrank
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            deleted += 1
+        return deleted
+
+
+class SharedDataStore:
+    def __init__(self, max_bytes=1024 * 1024 * 1024, auth_ttl_seconds=15 * 60, day_cache=None, wait_timeout_seconds=5 * 60):
+        self.max_bytes = max_bytes
+        self.auth_ttl_seconds = auth_ttl_seconds
+        # Longest a caller waits on another caller's download of the same key before giving up
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.day_cache = day_cache
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> DataFrame, least recently used first
+        self._sizes = {}
+        self._bytes = 0
+        self._in_flight = {}  # key -> Future shared by every caller waiting on that fetch
+        self._handlers = {}  # credential digest -> (expires_at, ClearGuideApiHandler)
+
+    def authorize(self, username, password):
+        # Authenticate once per credential pair and TTL; raises if ClearGuide rejects the credentials
+        digest = hashlib.sha256(f'{username}\0{password}'.encode('utf-8')).hexdigest()
+        with self._lock:
+            cached = self._handlers.get(digest)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+
+        handler = ClearGuideApiHandler(username=username, password=password)
+        with self._lock:
+            self._handlers[digest] = (time.monotonic() + self.auth_ttl_seconds, handler)
+        return handler
+
+    def get_or_fetch(self, key, fetch):
+        # key is (endpoint, route_id, start_utc, end_utc, granularity) with 'YYYY-MM-DD HH:MM:SS' UTC
+        # timestamps. Return the stored frame for key, or build it once, no matter how many callers ask
+        # at the same time: cached days come from the day cache and each run of uncached days is
+        # downloaded with fetch(start_utc, end_utc). Returned frames are shared between sessions and
+        # must be treated as read-only.
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                annotate(cache='hit')
+                return self._entries[key]
+
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not owner:
+            annotate(cache='coalesced')
+            try:
+                return future.result(timeout=self.wait_timeout_seconds)
+            except FutureTimeoutError:
+                raise Exception(f"Timed out after {self.wait_timeout_seconds}s waiting for the shared download of {key}")
+
+        # The in-flight entry is cleared and the shared Future resolved on every exit, including
+        # BaseExceptions (KeyboardInterrupt, Streamlit's rerun/stop), so waiters never block forever
+        error = None
+        try:
+            endpoint, route_id, start_utc, end_utc, granularity = key
+            if self.day_cache is not None:
+                segments = self.day_cache.plan(key)
+            else:
+                segments = [(start_utc, end_utc, None)]
+            fetched = sum(1 for segment in segments if segment[2] is None)
+            annotate(cache='disk' if not fetched else 'miss' if fetched == len(segments) else 'partial')
+
+            frames = []
+            for segment_start, segment_end, data in segments:
+                if data is None:
+                    data = fetch(segment_start, segment_end)
+                    if self.day_cache is not None:
+                        self.day_cache.save((endpoint, route_id, segment_start, segment_end, granularity), data)
+                frames.append(data)
+            data = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+            with self._lock:
+                self._put(key, data)
+        except BaseException as e:
+            error = e if isinstance(e, Exception) else Exception(f"Fetch of {key} was interrupted")
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            if error is None:
+                future.set_result(data)
+            else:
+                future.set_exception(error)
+        return data
+
+    def _put(self, key, data):
+        # Caller holds the lock
+        size = int(data.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        self._entries[key] = data
+        self._sizes[key] = size
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(evicted_key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'in_flight': len(self._in_flight),
+            }
+
+
+# Functions -----------------------------------------------------------------
+#-------------------------------------------------------------------------
+def day_cache_from_env(directory=None):
+    # Day cache configured the same way for the app and warmup.py; 10 GB unless CACHE_MAX_MB is set
+    max_mb = os.getenv('CACHE_MAX_MB', '10240')
+    max_age_days = os.getenv('CACHE_MAX_AGE_DAYS')
+    return DayCache(
+        directory or os.getenv('CACHE_DIR', '.cache/clearguide'),
+        settle_days=int(os.getenv('CACHE_SETTLE_DAYS', SETTLE_DAYS)),
+        max_bytes=int(max_mb) * 1024 * 1024 if max_mb else None,
+        max_age_days=float(max_age_days) if max_age_days else None,
+        recent_ttl_hours=float(os.getenv('CACHE_RECENT_TTL_HOURS', RECENT_TTL_HOURS))
+    )
@@ -0,0 +1,207 @@
+# Dense route x window x time-slot representation of the travel times.
+# The fetchers return long-format rows with string timestamps, and intervals with no reading are simply
+# absent. Here every window is laid out on a regular local wall-clock grid (5 minutes by default) as a
+# float32 array of shape (routes, periods, slots) with NaN for gaps, so means, time-of-day profiles, day
+# filters and gap counts are NaN-aware reductions over an axis instead of groupbys. Every window's slots
+# start at local midnight of its first day and cover whole days, so the slot axis reshapes to
+# (days, slots per day). The arrays can be saved as .npy files and memory-mapped by other processes.
+
+import json
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+from fetch_planner import LOCAL_TZ, TIMESTAMP_FORMAT
+
+SLOT_FREQ = '5min'
+ALL_DAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+class DenseTravelTimes:
+    def __init__(self, values, valid, route_ids, periods, first_days, freq=SLOT_FREQ):
+        # values: float32 (routes, periods, slots), NaN where there is no reading.
+        # valid: bool (periods, slots), True for slots inside the window that exist on the local clock
+        # (the hour skipped when daylight saving starts is not a gap).
+        # first_days: local date 'YYYY-MM-DD' of each period's first slot.
+        self.values = values
+        self.valid = valid
+        self.route_ids = list(route_ids)
+        self.periods = list(periods)
+        self.first_days = list(first_days)
+        self.freq = freq
+        self.slots_per_day = int(pd.Timedelta('1D') / pd.Timedelta(freq))
+        self.n_days = values.shape[2] // self.slots_per_day
+
+    def dates(self):
+        # (periods, days) array of local dates
+        return np.array([
+            pd.date_range(first_day, periods=self.n_days, freq='D').strftime('%Y-%m-%d').to_numpy()
+            for first_day in self.first_days
+        ]).reshape(len(self.periods), self.n_days)
+
+    def times(self):
+        # 'HH:MM' label of each slot within a day
+        return (pd.Timestamp('2000-01-01') + pd.timedelta_range(0, periods=self.slots_per_day, freq=self.freq)).strftime('%H:%M').to_numpy()
+
+    def day_mask(self, selected_days=None, excluded_dates=None):
+        # (periods, days) mask of the days kept by the day-of-week and excluded date filters
+        dates = self.dates()
+        day_names = pd.to_datetime(dates.ravel()).strftime('%A').to_numpy().reshape(dates.shape)
+        return np.isin(day_names, selected_days if selected_days is not None else ALL_DAYS) & ~np.isin(dates, excluded_dates or [])
+
+    def by_day(self, selected_days=None, excluded_dates=None):
+        # values as (routes, periods, days, slots per day), with filtered-out days set to NaN
+        values = self.values.reshape(len(self.route_ids), len(self.periods), self.n_days, self.slots_per_day)
+        if selected_days is None and not excluded_dates:
+            return values
+        keep = self.day_mask(selected_days, excluded_dates)
+        return np.where(keep[None, :, :, None], values, np.float32(np.nan))
+
+    def mean(self, selected_days=None, excluded_dates=None):
+        # Mean travel time and sample size per route and window
+        values = self.by_day(selected_days, excluded_dates)
+        n = (~np.isnan(values)).sum(axis=(2, 3))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.nansum(values, axis=(2, 3), dtype=np.float64) / n
+        return self._long_frame({'mean': mean, 'n': n})
+
+    def time_of_day_profile(self, selected_days=None, excluded_dates=None):
+        # Min, mean and max travel time per route, window and time of day across the kept days,
+        # in the layout of process_time_of_day. Times with no readings on any kept day are dropped.
+        # Min and max are taken over slot values, so readings averaged into one slot (the repeated
+        # hour when daylight saving ends) are not seen individually.
+        values = self.by_day(selected_days, excluded_dates)
+        with warnings.catch_warnings():
+            # All-NaN slices (times with no readings) are expected and dropped below
+            warnings.simplefilter('ignore', RuntimeWarning)
+            stats = {
+                'travel_time_min': np.nanmin(values, axis=2),
+                'travel_time_mean': np.nanmean(values, axis=2, dtype=np.float64),
+                'travel_time_max': np.nanmax(values, axis=2),
+            }
+        profile = pd.DataFrame({
+            'route_id': np.repeat(self.route_ids, len(self.periods) * self.slots_per_day),
+            'period': np.tile(np.repeat(self.periods, self.slots_per_day), len(self.route_ids)),
+            'time': np.tile(self.times(), len(self.route_ids) * len(self.periods)),
+            **{name: stat.ravel().astype(np.float64) for name, stat in stats.items()},
+        })
+        return profile[profile['travel_time_mean'].notna()].reset_index(drop=True)
+
+    def gap_statistics(self):
+        # Expected and missing slots per route and window, and the longest run of consecutive missing
+        # slots. Only slots inside the window count, so windows of different lengths compare fairly.
+        missing = np.isnan(self.values) & self.valid[None]
+        expected = np.broadcast_to(self.valid.sum(axis=1)[None], missing.shape[:2])
+
+        # Length of the missing run ending at every slot: distance back to the last slot that was not missing
+        slot = np.arange(missing.shape[2])
+        last_present = np.maximum.accumulate(np.where(missing, -1, slot), axis=2)
+        longest = np.where(missing, slot - last_present, 0).max(axis=2, initial=0)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            missing_pct = missing.sum(axis=2) / expected * 100
+        return self._long_frame({
+            'expected_slots': expected,
+            'missing_slots': missing.sum(axis=2),
+            'missing_pct': missing_pct,
+            'longest_gap_minutes': longest * pd.Timedelta(self.freq).total_seconds() / 60,
+        })
+
+    def _long_frame(self, columns):
+        # One row per route and window from (routes, periods) arrays
+        return pd.DataFrame({
+            'route_id': np.repeat(self.route_ids, len(self.periods)),
+            'period': np.tile(self.periods, len(self.route_ids)),
+            **{name: np.asarray(column).ravel() for name, column in columns.items()},
+        })
+
+    def save(self, directory):
+        # values.npy and valid.npy plus the calendar in metadata.json
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'values.npy'), self.values)
+        np.save(os.path.join(directory, 'valid.npy'), self.valid)
+        with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+            json.dump({
+                'route_ids': [int(route_id) for route_id in self.route_ids],
+                'periods': self.periods,
+                'first_days': self.first_days,
+                'freq': self.freq,
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        # Memory-mapped read-only by default, so worker processes share the pages without copying
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            metadata = json.load(f)
+        return cls(
+            np.load(os.path.join(directory, 'values.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, 'valid.npy'), mmap_mode=mmap_mode),
+            metadata['route_ids'],
+            metadata['periods'],
+            metadata['first_days'],
+            metadata['freq']
+        )
+
+
+# Functions -----------------------------------------------------------------
+#-------------------------------------------------------------------------
+def to_dense(combined_data, windows=None, freq=SLOT_FREQ):
+    # windows maps each window name to its (start, end) local datetime strings, so readings missing at
+    # the edges of a window count as gaps; without it each window spans its first to last reading.
+    # Readings that share a slot (the repeated hour when daylight saving ends, or data finer than freq)
+    # are averaged.
+    periods = list(windows) if windows else list(dict.fromkeys(combined_data['period']))
+    if windows:
+        bounds = {name: windows[name] for name in periods}
+    else:
+        timestamps = combined_data.groupby('period')['timestamp']
+        bounds = {name: (timestamps.min()[name], timestamps.max()[name]) for name in periods}
+
+    step = pd.Timedelta(freq)
+    slots_per_day = int(pd.Timedelta('1D') / step)
+    first_days = [bounds[name][0][:10] for name in periods]
+    n_days = max(
+        (pd.Timestamp(bounds[name][1][:10]) - pd.Timestamp(first_day)).days + 1
+        for name, first_day in zip(periods, first_days)
+    )
+    n_slots = n_days * slots_per_day
+
+    # Slots inside each window that exist on the local clock
+    valid = np.zeros((len(periods), n_slots), dtype=bool)
+    for idx, (name, first_day) in enumerate(zip(periods, first_days)):
+        wall_clock = pd.date_range(first_day, periods=n_slots, freq=freq)
+        start, end = (pd.Timestamp(datetime_str) for datetime_str in bounds[name])
+        exists = wall_clock.tz_localize(LOCAL_TZ, ambiguous=np.ones(n_slots, dtype=bool), nonexistent='NaT').notna()
+        valid[idx] = (wall_clock >= start) & (wall_clock <= end) & exists
+
+    data = combined_data[combined_data['period'].isin(periods) & combined_data['travel_time'].notna()]
+    route_ids = list(dict.fromkeys(data['route_id']))
+    period_index = data['period'].map({name: idx for idx, name in enumerate(periods)}).to_numpy()
+    route_index = data['route_id'].map({route_id: idx for idx, route_id in enumerate(route_ids)}).to_numpy()
+    first_slot_time = data['period'].map({name: pd.Timestamp(first_day) for name, first_day in zip(periods, first_days)})
+    slot_index = ((pd.to_datetime(data['timestamp'], format=TIMESTAMP_FORMAT) - first_slot_time) // step).to_numpy()
+
+    in_grid = (slot_index >= 0) & (slot_index < n_slots)
+    target = (route_index[in_grid], period_index[in_grid], slot_index[in_grid])
+    sums = np.zeros((len(route_ids), len(periods), n_slots))
+    counts = np.zeros((len(route_ids), len(periods), n_slots))
+    np.add.at(sums, target, data['travel_time'].to_numpy(dtype=np.float64)[in_grid])
+    np.add.at(counts, target, 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = (sums / counts).astype(np.float32)
+
+    return DenseTravelTimes(values, valid, route_ids, periods, first_days, freq)
+
+
+# Example usage
+# windows = {
+#     'Before': ("2024-10-01 00:00:00", "2024-10-07 23:59:59"),
+#     'After': ("2024-10-15 00:00:00", "2024-10-21 23:59:59"),
+# }
+# combined_data = timeseries_comparison([12345, 67890], windows, username, password)
+# dense = to_dense(combined_data, windows)
+# print(dense.gap_statistics())
+# print(dense.mean(selected_days=['Tuesday', 'Wednesday', 'Thursday']))
+# dense.save('study_dense')
+# shared = DenseTravelTimes.load('study_dense')  # memory-mapped
@@ -0,0 +1,156 @@
+# Export study results as Parquet or Arrow IPC files with fixed schemas, so GIS and reporting tools
+# (or other worker processes) can read or memory-map them instead of pulling the data again.
+#
+# Every table is long format so its columns do not depend on how many windows were compared or what
+# they were named. Timestamps are local wall-clock time in America/Denver, matching the fetchers.
+
+import io
+import os
+import threading
+import zipfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+SCHEMA_VERSION = '3'
+
+SCHEMAS = {
+    'timeseries': pa.schema([
+        ('route_id', pa.int64()),
+        ('period', pa.string()),
+        ('timestamp', pa.timestamp('s')),
+        ('travel_time', pa.float64()),
+    ]),
+    'speed_contours': pa.schema([
+        ('route_id', pa.int64()),
+        ('period', pa.string()),
+        ('timestamp', pa.timestamp('s')),
+        ('distance', pa.float64()),
+        ('speed', pa.float64()),
+    ]),
+    'summary': pa.schema([
+        ('route_id', pa.int64()),
+        ('period', pa.string()),
+        ('baseline', pa.string()),
+        ('mean', pa.float64()),
+        ('n', pa.int64()),
+        ('diff', pa.float64()),
+        ('pct_change', pa.float64()),
+        ('p_value', pa.float64()),
+        ('diff_ci_low', pa.float64()),
+        ('diff_ci_high', pa.float64()),
+        ('pct_change_ci_low', pa.float64()),
+        ('pct_change_ci_high', pa.float64()),
+        ('confidence', pa.float64()),
+    ]),
+    'time_of_day': pa.schema([
+        ('route_id', pa.int64()),
+        ('period', pa.string()),
+        ('time', pa.string()),
+        ('travel_time_min', pa.float64()),
+        ('travel_time_mean', pa.float64()),
+        ('travel_time_max', pa.float64()),
+        ('travel_time_p15', pa.float64()),
+        ('travel_time_p50', pa.float64()),
+        ('travel_time_p85', pa.float64()),
+    ]),
+    'contour_diffs': pa.schema([
+        ('route_id', pa.int64()),
+        ('baseline', pa.string()),
+        ('comparison', pa.string()),
+        ('hour', pa.int64()),
+        ('binned_distance', pa.float64()),
+        ('baseline_speed', pa.float64()),
+        ('comparison_speed', pa.float64()),
+        ('diff', pa.float64()),
+        ('percent_change', pa.float64()),
+    ]),
+}
+
+FILE_EXTENSIONS = {'parquet': 'parquet', 'arrow': 'arrow'}
+
+# Caveats written into a table's schema metadata alongside the schema version
+TABLE_NOTES = {
+    'time_of_day': (
+        'min/mean/max may come from the dense 5-minute grid (dense.py), as in the app: values then have '
+        'float32 precision, and on the day daylight saving ends the two readings in the repeated '
+        '01:00-01:55 hour are averaged before min and max are taken.'
+    ),
+}
+
+
+# Functions -----------------------------------------------------------------
+#-------------------------------------------------------------------------
+def contour_diff_frame(summary_pivoted, route_id, baseline, comparison):
+    # Flatten one process_speed_contours result (hour x distance, one column per window) to the
+    # contour_diffs layout
+    return pd.DataFrame({
+        'route_id': route_id,
+        'baseline': baseline,
+        'comparison': comparison,
+        'hour': summary_pivoted['hour'],
+        'binned_distance': summary_pivoted['binned_distance'],
+        'baseline_speed': summary_pivoted[baseline],
+        'comparison_speed': summary_pivoted[comparison],
+        'diff': summary_pivoted['diff'],
+        'percent_change': summary_pivoted['percent_change'],
+    })
+
+def to_arrow_table(name, data):
+    schema = SCHEMAS[name]
+    data = data[schema.names].copy()
+    if 'timestamp' in data:
+        data['timestamp'] = pd.to_datetime(data['timestamp'])
+    table = pa.Table.from_pandas(data, schema=schema, preserve_index=False)
+    metadata = {
+        'schema_version': SCHEMA_VERSION,
+        'table': name,
+        'timezone': 'America/Denver (local wall clock)',
+    }
+    if name in TABLE_NOTES:
+        metadata['notes'] = TABLE_NOTES[name]
+    return table.replace_schema_metadata(metadata)
+
+def write_table(table, sink, file_format='parquet'):
+    if file_format == 'parquet':
+        pq.write_table(table, sink)
+    elif file_format == 'arrow':
+        # Uncompressed IPC file format so readers can memory-map it without copying
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        raise ValueError(f"Unknown export format: {file_format}")
+
+def write_study(directory, tables, file_format='parquet'):
+    # tables maps a schema name to a DataFrame; returns the written file paths
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for name, data in tables.items():
+        path = os.path.join(directory, f'{name}.{FILE_EXTENSIONS[file_format]}')
+        # Write then rename, like the day cache, so a reader memory-mapping the file never sees it half written
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            write_table(to_arrow_table(name, data), temp_path, file_format)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        paths.append(path)
+    return paths
+
+def export_bundle(tables, file_format='parquet'):
+    # Zip archive of the study tables, for a download button
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, data in tables.items():
+            sink = pa.BufferOutputStream()
+            write_table(to_arrow_table(name, data), sink, file_format)
+            archive.writestr(f'{name}.{FILE_EXTENSIONS[file_format]}', sink.getvalue().to_pybytes())
+    return buffer.getvalue()
+
+def read_table(path):
+    # Memory-map the file rather than reading it into the heap
+    if path.endswith('.arrow'):
+        return ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return pq.read_table(path, memory_map=True)
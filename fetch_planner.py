@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+import pytz
+
+from api.function import ClearGuideApiHandler
+from instrumentation import span
+
+LOCAL_TZ = pytz.timezone('America/Denver')
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Windows are inclusive to the second (e.g. "... 23:59:59" then "... 00:00:00"), so a gap of one
+# second or less between two windows means they are adjacent and can share one API request
+ADJACENT_GAP = timedelta(seconds=1)
+
+
+class FetchCancelled(Exception):
+    pass
+
+
+# Functions -----------------------------------------------------------------
+#-------------------------------------------------------------------------
+def to_utc(local_datetime_str):
+    return LOCAL_TZ.localize(datetime.strptime(local_datetime_str, TIMESTAMP_FORMAT)).astimezone(timezone.utc)
+
+def plan_fetch_ranges(windows):
+    # windows maps a window name to its (start, end) local datetime strings.
+    # Returns the minimal list of (start_utc, end_utc, [window names]) ranges covering every window,
+    # merging windows that overlap or sit next to each other.
+    ordered = sorted(
+        (datetime.strptime(start, TIMESTAMP_FORMAT), datetime.strptime(end, TIMESTAMP_FORMAT), name)
+        for name, (start, end) in windows.items()
+    )
+
+    merged = []
+    for start, end, name in ordered:
+        if merged and start - merged[-1][1] <= ADJACENT_GAP:
+            merged[-1][1] = max(merged[-1][1], end)
+            merged[-1][2].append(name)
+        else:
+            merged.append([start, end, [name]])
+
+    return [
+        (to_utc(start.strftime(TIMESTAMP_FORMAT)), to_utc(end.strftime(TIMESTAMP_FORMAT)), names)
+        for start, end, names in merged
+    ]
+
+def slice_window(data, start, end):
+    # Timestamps are local 'YYYY-MM-DD HH:MM:SS' strings, so lexical comparison is chronological
+    return data[(data['timestamp'] >= start) & (data['timestamp'] <= end)]
+
+def fetch_routes(api_url, route_ids, start_datetime, end_datetime, username, password, granularity, fetch_route, store=None, cancel_event=None):
+    # Shared body of the endpoint fetchers (get_timeseries_data, get_speed_data): authenticate, then
+    # fetch every route over the range. fetch_route(cg_api_handler, route_id, start, end) requests and
+    # parses one route between 'YYYY-MM-DD HH:MM:SS' UTC timestamps.
+    start = start_datetime.strftime(TIMESTAMP_FORMAT)
+    end = end_datetime.strftime(TIMESTAMP_FORMAT)
+
+    # With a shared store, credentials are checked once per auth TTL and each route range is
+    # downloaded at most once per process, however many sessions ask for it
+    if store is None:
+        cg_api_handler = ClearGuideApiHandler(username=username, password=password)
+    else:
+        cg_api_handler = store.authorize(username, password)
+    all_parsed_data = []  # Initialize empty list to store all route data
+
+    try:
+        for route_id in route_ids:
+            # Checked before each request rather than inside the store's fetch, so a cancelled job
+            # never fails another session waiting on the same download
+            if cancel_event is not None and cancel_event.is_set():
+                raise FetchCancelled()
+            with span('fetch_route', route_id=route_id) as record:
+                if store is None:
+                    route_data = fetch_route(cg_api_handler, route_id, start, end)
+                else:
+                    key = (api_url, route_id, start, end, granularity)
+                    route_data = store.get_or_fetch(
+                        key, lambda range_start, range_end: fetch_route(cg_api_handler, route_id, range_start, range_end)
+                    )
+                record['rows'] = len(route_data)
+            all_parsed_data.append(route_data)
+
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        raise
+
+    # Combine all route data into a single DataFrame
+    return pd.concat(all_parsed_data, ignore_index=True)
+
+def fetch_windows(get_data, route_ids, windows, username, password, granularity, store=None, cancel_event=None, on_range=None):
+    # Fetch each merged range once, then cut every window back out of the range that covers it.
+    # Rows that fall in more than one window appear once per window.
+    # Background jobs pass a threading.Event checked before each range and by get_data before each
+    # request (raising FetchCancelled once set), and an on_range(names) callback run after each range
+    # lands, for progress reporting.
+    window_data = {}
+    for start_utc, end_utc, names in plan_fetch_ranges(windows):
+        if cancel_event is not None and cancel_event.is_set():
+            raise FetchCancelled()
+        range_data = get_data(route_ids, start_utc, end_utc, username, password, granularity, store, cancel_event=cancel_event)
+        for name in names:
+            window_data[name] = slice_window(range_data, *windows[name]).assign(period=name)
+        if on_range is not None:
+            on_range(names)
+
+    # Keep the caller's window order so the first window reads as the default baseline
+    return pd.concat([window_data[name] for name in windows], ignore_index=True)
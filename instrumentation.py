@@ -0,0 +1,186 @@
+# Lightweight timing and payload instrumentation for the fetch / parse / analysis pipeline.
+# Spans are recorded per thread (each Streamlit session runs its script in its own thread),
+# emitted as structured JSON log lines, and rolled up into process-wide counters that can be
+# exposed in Prometheus text format.
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger('travel_times.instrumentation')
+
+# Per-thread state: the stack of open spans and the list of spans collected so far
+_local = threading.local()
+
+# Process-wide totals keyed by span name, used for the Prometheus exposition
+_totals_lock = threading.Lock()
+_totals = {}
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+_metrics_server_failed = False
+
+
+def configure_logging(level=None):
+    # Emit span records as one JSON object per line on stderr; safe to call on every rerun
+    root = logging.getLogger('travel_times')
+    root.setLevel(level or os.getenv('TRAVEL_TIMES_LOG_LEVEL', 'INFO'))
+    if not root.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        root.addHandler(handler)
+        root.propagate = False
+
+
+def _state():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+        _local.collected = None
+    return _local
+
+
+@contextmanager
+def collect():
+    # Collect every span finished on this thread while the block is running
+    state = _state()
+    previous = state.collected
+    state.collected = []
+    try:
+        yield state.collected
+    finally:
+        state.collected = previous
+
+
+@contextmanager
+def span(name, **fields):
+    state = _state()
+    record = {
+        'name': name,
+        'depth': len(state.stack),
+        'duration_s': None,
+        'bytes': None,
+        'rows': None,
+        'cache': None,
+    }
+    record.update(fields)
+    state.stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = str(e)
+        raise
+    finally:
+        record['duration_s'] = round(time.perf_counter() - start, 6)
+        state.stack.pop()
+        if state.collected is not None:
+            state.collected.append(record)
+        _record_totals(record)
+        logger.info(json.dumps(record, default=str))
+
+
+def annotate(**fields):
+    # Attach fields (bytes, rows, cache, ...) to the innermost open span on this thread
+    state = _state()
+    if state.stack:
+        state.stack[-1].update(fields)
+
+
+def traced(name=None):
+    # Decorator form of span(); records the row count when the function returns a frame or list
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__) as record:
+                result = func(*args, **kwargs)
+                if hasattr(result, 'shape') or isinstance(result, list):
+                    record['rows'] = len(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def _record_totals(record):
+    with _totals_lock:
+        totals = _totals.setdefault(record['name'], {
+            'count': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0, 'rows': 0, 'cache_hits': 0, 'cache_misses': 0, 'cache_coalesced': 0
+        })
+        totals['count'] += 1
+        totals['seconds'] += record['duration_s']
+        totals['bytes'] += record['bytes'] or 0
+        totals['rows'] += record['rows'] or 0
+        if 'error' in record:
+            totals['errors'] += 1
+        if record['cache'] in ('hit', 'disk'):
+            totals['cache_hits'] += 1
+        elif record['cache'] in ('miss', 'partial'):
+            totals['cache_misses'] += 1
+        elif record['cache'] == 'coalesced':
+            totals['cache_coalesced'] += 1
+
+
+def prometheus_text():
+    metrics = [
+        ('count', 'travel_times_span_total', 'counter', 'Number of completed spans'),
+        ('errors', 'travel_times_span_errors_total', 'counter', 'Number of spans that raised'),
+        ('seconds', 'travel_times_span_seconds_total', 'counter', 'Total time spent in spans'),
+        ('bytes', 'travel_times_span_bytes_total', 'counter', 'Bytes downloaded within spans'),
+        ('rows', 'travel_times_span_rows_total', 'counter', 'Rows produced within spans'),
+        ('cache_hits', 'travel_times_span_cache_hits_total', 'counter', 'Spans served from the memory or disk cache'),
+        ('cache_misses', 'travel_times_span_cache_misses_total', 'counter', 'Spans not served from cache'),
+        ('cache_coalesced', 'travel_times_span_cache_coalesced_total', 'counter', 'Spans that waited on an identical in-flight fetch'),
+    ]
+    with _totals_lock:
+        snapshot = {name: dict(values) for name, values in _totals.items()}
+
+    lines = []
+    for key, metric, metric_type, help_text in metrics:
+        lines.append(f'# HELP {metric} {help_text}')
+        lines.append(f'# TYPE {metric} {metric_type}')
+        for name in sorted(snapshot):
+            lines.append(f'{metric}{{span="{name}"}} {snapshot[name][key]}')
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of stderr
+        pass
+
+
+def start_metrics_server(port=None):
+    # Serve /metrics on the given port (or METRICS_PORT) from a daemon thread; no-op if unset
+    # Called on every Streamlit script run, so concurrent sessions race here; only one may bind,
+    # and a port that cannot be bound is logged once rather than failing the page.
+    global _metrics_server, _metrics_server_failed
+    port = port or os.getenv('METRICS_PORT')
+    if not port:
+        return None
+    with _metrics_server_lock:
+        if _metrics_server is not None or _metrics_server_failed:
+            return _metrics_server
+        try:
+            _metrics_server = HTTPServer(('0.0.0.0', int(port)), _MetricsHandler)
+        except OSError as e:
+            _metrics_server_failed = True
+            logger.warning(json.dumps({'event': 'metrics_server_failed', 'port': int(port), 'error': str(e)}))
+            return None
+        threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+        return _metrics_server
@@ -0,0 +1,124 @@
+# Background fetch jobs for the app, so a study downloads without blocking the page.
+# A job fetches each route on its own worker thread and publishes that route's travel times (and
+# speed contours) the moment they are complete, so the app can draw the first routes while the rest
+# are still downloading. Progress is counted per route and window as each merged fetch range lands.
+# cancel() stops every route before its next API request; the job counts as done at once, and a
+# request already in flight finishes in the background with its result dropped.
+
+import threading
+
+from fetch_planner import FetchCancelled, fetch_windows, plan_fetch_ranges
+from instrumentation import collect, span
+from speed_contours import get_speed_data
+from timeseries import get_timeseries_data
+
+FETCHERS = {
+    'timeseries': get_timeseries_data,
+    'speed_contours': get_speed_data,
+}
+
+
+class FetchJob:
+    def __init__(self, route_ids, windows, username, password, granularities, store=None):
+        # granularities maps each endpoint to fetch ('timeseries', 'speed_contours') to its granularity
+        self.route_ids = list(route_ids)
+        self.windows = dict(windows)
+        self.username = username
+        self.password = password
+        self.granularities = dict(granularities)
+        self.store = store
+
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self._futures = []
+        self._ranges_per_endpoint = len(plan_fetch_ranges(self.windows))
+        self._ranges_done = {route_id: 0 for route_id in self.route_ids}
+        # route_id -> window name -> number of endpoints whose data for that window has landed
+        self._windows_done = {route_id: dict.fromkeys(self.windows, 0) for route_id in self.route_ids}
+        self.results = {}  # route_id -> {endpoint: DataFrame}, added once all of a route's endpoints are in
+        self.errors = {}  # route_id -> error message
+        self.spans = []
+
+    def start(self, executor):
+        self._futures = [executor.submit(self._run_route, route_id) for route_id in self.route_ids]
+        return self
+
+    def cancel(self):
+        # Routes not yet started never run; running routes stop before their next request
+        self._cancel_event.set()
+        for future in self._futures:
+            future.cancel()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def done(self):
+        return self.cancelled or all(future.done() for future in self._futures)
+
+    def progress(self):
+        # Fraction of all fetch ranges landed, across every route and endpoint
+        total = len(self.route_ids) * len(self.granularities) * self._ranges_per_endpoint
+        with self._lock:
+            return sum(self._ranges_done.values()) / total if total else 1.0
+
+    def route_progress(self, route_id):
+        # (fraction of the route's fetch ranges landed, {window name: fraction of endpoints landed})
+        total = len(self.granularities) * self._ranges_per_endpoint
+        with self._lock:
+            windows_done = {
+                name: count / len(self.granularities) for name, count in self._windows_done[route_id].items()
+            }
+            return (self._ranges_done[route_id] / total if total else 1.0), windows_done
+
+    def completed_routes(self):
+        # Routes whose data is ready, in the order they were requested
+        with self._lock:
+            return [route_id for route_id in self.route_ids if route_id in self.results]
+
+    def _range_landed(self, route_id, names):
+        with self._lock:
+            self._ranges_done[route_id] += 1
+            for name in names:
+                self._windows_done[route_id][name] += 1
+
+    def _run_route(self, route_id):
+        with collect() as route_spans:
+            try:
+                frames = {}
+                for endpoint, granularity in self.granularities.items():
+                    with span(f'fetch_job_{endpoint}', route_id=route_id, granularity=granularity) as record:
+                        frames[endpoint] = fetch_windows(
+                            FETCHERS[endpoint],
+                            [route_id],
+                            self.windows,
+                            self.username,
+                            self.password,
+                            granularity,
+                            self.store,
+                            cancel_event=self._cancel_event,
+                            on_range=lambda names: self._range_landed(route_id, names)
+                        )
+                        record['rows'] = len(frames[endpoint])
+                with self._lock:
+                    if not self.cancelled:
+                        self.results[route_id] = frames
+            except FetchCancelled:
+                pass
+            except Exception as e:
+                with self._lock:
+                    self.errors[route_id] = str(e)
+            finally:
+                with self._lock:
+                    self.spans.extend(route_spans)
+
+
+# Example usage
+# from concurrent.futures import ThreadPoolExecutor
+# windows = {
+#     'Before': ("2024-10-01 00:00:00", "2024-10-07 23:59:59"),
+#     'After': ("2024-10-15 00:00:00", "2024-10-21 23:59:59"),
+# }
+# job = FetchJob([12345, 67890], windows, username, password, {'timeseries': '5min', 'speed_contours': 'hour'})
+# job.start(ThreadPoolExecutor(max_workers=4))
+# print(job.progress(), job.completed_routes())
@@ -0,0 +1,69 @@
+# Mergeable quantile sketches for time-of-day travel time percentiles.
+# Each value is counted in a logarithmic bucket (the DDSketch scheme), so any quantile read back from
+# a sketch is within RELATIVE_ACCURACY of the exact one. A sketch is just (bucket, count) rows, so
+# sketches built per day can be cached and merged for any day filter or window length by summing
+# counts per bucket, without going back to the raw samples.
+
+import numpy as np
+import pandas as pd
+
+RELATIVE_ACCURACY = 0.01
+QUANTILES = (0.15, 0.5, 0.85)
+
+# Travel times are positive; anything smaller is counted in the lowest bucket
+MIN_VALUE = 1e-3
+
+SKETCH_KEYS = ['route_id', 'period', 'time']
+
+
+# Functions -----------------------------------------------------------------
+#-------------------------------------------------------------------------
+def _gamma(relative_accuracy):
+    return (1 + relative_accuracy) / (1 - relative_accuracy)
+
+def bucket_index(values, relative_accuracy=RELATIVE_ACCURACY):
+    values = np.maximum(np.asarray(values, dtype=float), MIN_VALUE)
+    return np.ceil(np.log(values) / np.log(_gamma(relative_accuracy))).astype(np.int32)
+
+def bucket_value(index, relative_accuracy=RELATIVE_ACCURACY):
+    # Representative value of a bucket: within relative_accuracy of everything counted in it
+    gamma = _gamma(relative_accuracy)
+    return 2 * gamma ** np.asarray(index, dtype=float) / (gamma + 1)
+
+def build_daily_sketches(combined_data, relative_accuracy=RELATIVE_ACCURACY):
+    # One sketch per route, window, local date and time of day
+    combined_data = combined_data[combined_data['travel_time'].notna()]
+    timestamps = pd.to_datetime(combined_data['timestamp'])
+    data = pd.DataFrame({
+        'route_id': combined_data['route_id'].to_numpy(),
+        'period': combined_data['period'].to_numpy(),
+        'date': timestamps.dt.strftime('%Y-%m-%d').to_numpy(),
+        'time': timestamps.dt.strftime('%H:%M').to_numpy(),
+        'bucket': bucket_index(combined_data['travel_time'], relative_accuracy),
+    })
+    return data.groupby(['route_id', 'period', 'date', 'time', 'bucket']).size().rename('count').reset_index()
+
+def filter_sketch_days(sketches, selected_days, excluded_dates):
+    # Day name is looked up once per distinct date rather than once per row
+    dates = pd.Series(sketches['date'].unique())
+    day_names = dict(zip(dates, pd.to_datetime(dates).dt.strftime('%A')))
+    keep = sketches['date'].map(day_names).isin(selected_days) & ~sketches['date'].isin(excluded_dates)
+    return sketches[keep]
+
+def merge_sketches(sketches, keys=SKETCH_KEYS):
+    # Collapse daily (or any finer) sketches into one sketch per key by summing bucket counts
+    return sketches.groupby(keys + ['bucket'])['count'].sum().reset_index()
+
+def sketch_quantiles(merged, quantiles=QUANTILES, keys=SKETCH_KEYS, relative_accuracy=RELATIVE_ACCURACY):
+    # Read quantiles off merged sketches: the first bucket whose cumulative count passes the rank.
+    # Returns one row per key with a travel_time_pNN column per quantile.
+    merged = merged.sort_values(keys + ['bucket'])
+    cumulative = merged.groupby(keys)['count'].cumsum()
+    total = merged.groupby(keys)['count'].transform('sum')
+
+    result = merged[keys].drop_duplicates().set_index(keys)
+    for q in quantiles:
+        passed = merged[cumulative > q * (total - 1)]
+        bucket = passed.groupby(keys)['bucket'].first()
+        result[f'travel_time_p{round(q * 100):02d}'] = pd.Series(bucket_value(bucket, relative_accuracy), index=bucket.index)
+    return result.reset_index()
@@ -1,20 +1,15 @@
-import datetime
-from api.function import ClearGuideApiHandler
 from datetime import datetime, timezone
 import pandas as pd  
 import pytz
-from scipy import stats
-import os
-from dotenv import load_dotenv
 import plotly.graph_objects as go
-from geopy.distance import geodesic
-from lxml import etree
+from instrumentation import traced
+from fetch_planner import fetch_routes, fetch_windows
 
-# Load environment variables
-load_dotenv()
+SPEED_CONTOURS_API_URL = 'https://api.iteris-clearguide.com/v1/route/spatial/contours/'
 
 # Functions -----------------------------------------------------------------
 #-------------------------------------------------------------------------
+@traced()
 def parse_json_response(response, route_id):
 
     data = []
@@ -40,6 +35,9 @@ def parse_json_response(response, route_id):
     return data
 
 def calculate_distances(intersections, direction):
+    # geopy is only needed for heatmaps, so it is imported on first use
+    from geopy.distance import geodesic
+
     if direction in ['Northbound', 'Eastbound']:
         start_point = intersections[-1]  # Last intersection (northernmost or easternmost)
     else:
@@ -53,6 +51,7 @@ def calculate_distances(intersections, direction):
     return distances
 
 # Read in a KML file for the y axis of the heatmap
+@traced()
 def read_kml_intersections(kml_file):
     from lxml import etree
     
@@ -83,70 +82,43 @@ def read_kml_intersections(kml_file):
     
     return intersections
 
-def get_speed_data(route_ids, start_datetime, end_datetime, username, password):
+@traced()
+def get_speed_data(route_ids, start_datetime, end_datetime, username, password, granularity='hour', store=None, cancel_event=None):
     # Define the API parameters
-    API_URL = 'https://api.iteris-clearguide.com/v1/route/spatial/contours/'
+    API_URL = SPEED_CONTOURS_API_URL
     CUSTOMER_KEY = 'ut'
     ROUTE_ID_TYPE = 'customer_route_number'
-    # Use datetime strings directly (YYYY-MM-DD HH:MM:SS format)
-    START_TIMESTAMP = start_datetime.strftime("%Y-%m-%d %H:%M:%S")
-    END_TIMESTAMP = end_datetime.strftime("%Y-%m-%d %H:%M:%S")
     METRIC = 'avg_speed'
-    GRANULARITY = 'hour'
     INCLUDE_HOLIDAYS = 'false'
 
-    cg_api_handler = ClearGuideApiHandler(username=username, password=password)
-    all_parsed_data = []
+    def fetch_route(cg_api_handler, route_id, start_timestamp, end_timestamp):
+        # Timestamps are UTC 'YYYY-MM-DD HH:MM:SS' strings
+        query = f'{API_URL}?customer_key={CUSTOMER_KEY}&route_id={route_id}&route_id_type={ROUTE_ID_TYPE}&s_timestamp={start_timestamp}&e_timestamp={end_timestamp}&metrics={METRIC}&holidays={INCLUDE_HOLIDAYS}&granularity={granularity}'
 
-    try:
-        for route_id in route_ids:
-            query = f'{API_URL}?customer_key={CUSTOMER_KEY}&route_id={route_id}&route_id_type={ROUTE_ID_TYPE}&s_timestamp={START_TIMESTAMP}&e_timestamp={END_TIMESTAMP}&metrics={METRIC}&holidays={INCLUDE_HOLIDAYS}&granularity={GRANULARITY}'
+        response = cg_api_handler.call(url=query)
 
-            response = cg_api_handler.call(url=query)
+        if 'error' in response and response['error']:
+            raise Exception(f"Error fetching response for route_id {route_id}... Message: {response.get('msg', 'No message provided')}")
 
-            if 'error' in response and response['error']:
-                raise Exception(f"Error fetching response for route_id {route_id}... Message: {response.get('msg', 'No message provided')}")
+        # Parse JSON response and convert list of lists to DataFrame
+        route_data = parse_json_response(response, route_id)
+        return pd.DataFrame(route_data, columns=['route_id', 'timestamp', 'distance', 'speed'])
 
-            # Parse JSON response and append to all_parsed_data
-            route_data = parse_json_response(response, route_id)
-            # Convert list of lists to DataFrame before appending
-            df = pd.DataFrame(route_data, columns=['route_id', 'timestamp', 'distance', 'speed'])
-            all_parsed_data.append(df)
-        
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        raise
+    # Authentication, the shared store and cancellation are handled the same way for every endpoint
+    return fetch_routes(API_URL, route_ids, start_datetime, end_datetime, username, password, granularity, fetch_route, store, cancel_event)
+
+@traced()
+def speed_comparison(route_ids, windows, username, password, granularity='hour', store=None):
+    # windows maps each window name to its (start, end) local datetime strings
+    return fetch_windows(get_speed_data, route_ids, windows, username, password, granularity, store)
+
+@traced()
+def process_speed_contours(combined_data, selected_days, excluded_dates, baseline=None, comparison=None): # assume that a single route is being processed here
+    # Diff the comparison window (default: last) against the baseline window (default: first)
+    periods = list(dict.fromkeys(combined_data['period']))
+    baseline = baseline or periods[0]
+    comparison = comparison or periods[-1]
 
-    # Combine all route data into a single DataFrame
-    return pd.concat(all_parsed_data, ignore_index=True)
-    
-def speed_comparison(route_ids, window1_start, window1_end, window2_start, window2_end, username, password):
-    # Convert both windows to datetime objects
-    local_tz = pytz.timezone('America/Denver')
-    windows = {
-        'window1': (
-            local_tz.localize(datetime.strptime(window1_start, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc),
-            local_tz.localize(datetime.strptime(window1_end, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc)
-        ),
-        'window2': (
-            local_tz.localize(datetime.strptime(window2_start, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc),
-            local_tz.localize(datetime.strptime(window2_end, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc)
-        )
-    }
-
-    # Fetch data for both windows
-    data_window1 = get_speed_data(route_ids, windows['window1'][0], windows['window1'][1], username, password)
-    data_window2 = get_speed_data(route_ids, windows['window2'][0], windows['window2'][1], username, password)
-
-    # Add period column to each dataset
-    data_window1['period'] = 'window1'
-    data_window2['period'] = 'window2'
-
-    # Combine the datasets
-    combined_data = pd.concat([data_window1, data_window2], ignore_index=True)
-    return combined_data
-
-def process_speed_contours(combined_data, selected_days, excluded_dates): # assume that a single route is being processed here
     # Convert timestamp to datetime first
     combined_data['timestamp'] = pd.to_datetime(combined_data['timestamp'])
 
@@ -173,13 +145,14 @@ def process_speed_contours(combined_data, selected_days, excluded_dates): # assu
     summary_pivoted = summary.pivot(index=['hour', 'binned_distance'], columns='period', values='speed').reset_index() # NOT GROUPING BY ROUTE_ID assume that a single route is being processed here
 
     # Calculate the difference and percent change
-    summary_pivoted['diff'] = summary_pivoted['window2'] - summary_pivoted['window1']
-    summary_pivoted['percent_change'] = (summary_pivoted['diff'] / summary_pivoted['window1']) * 100
+    summary_pivoted['diff'] = summary_pivoted[comparison] - summary_pivoted[baseline]
+    summary_pivoted['percent_change'] = (summary_pivoted['diff'] / summary_pivoted[baseline]) * 100
 
     return summary_pivoted
 
 
-def build_heatmaps(summary_pivoted, kml_file_path, direction):
+@traced()
+def build_heatmaps(summary_pivoted, kml_file_path, direction, title=None):
     # Plotting the speed difference in a heatmap using Plotly
     intersections = read_kml_intersections(kml_file_path)
 
@@ -208,7 +181,7 @@ def build_heatmaps(summary_pivoted, kml_file_path, direction):
 
     # Update layout
     fig.update_layout(
-        title=f"Speed Difference Heatmap - {direction}",
+        title=title or f"Speed Difference Heatmap - {direction}",
         xaxis_title="Hour of Day",
         yaxis_title="Distance (miles)"
         # height=1000,  # Adjust the height as needed
@@ -229,12 +202,15 @@ def build_heatmaps(summary_pivoted, kml_file_path, direction):
 # -------------------------------------------------
 # Example usage:
 
+# import config, os
+# config.init()
+
 # example_data = speed_comparison(
 #     route_ids=[13236], 
-#     window1_start="2024-09-01 00:00:00", 
-#     window1_end="2024-09-30 23:59:59", 
-#     window2_start="2024-10-01 00:00:00", 
-#     window2_end="2024-10-31 23:59:59", 
+#     windows={
+#         'Window 1': ("2024-09-01 00:00:00", "2024-09-30 23:59:59"),
+#         'Window 2': ("2024-10-01 00:00:00", "2024-10-31 23:59:59"),
+#     },
 #     username=os.getenv('CG_USERNAME'), 
 #     password=os.getenv('CG_PASSWORD')
 # )
@@ -1,18 +1,22 @@
-import datetime
-from api.function import ClearGuideApiHandler
 from datetime import datetime, timezone
 import pandas as pd  
 import pytz
-from scipy import stats
-import os
-from dotenv import load_dotenv
 import plotly.graph_objects as go
+from instrumentation import traced
+from fetch_planner import fetch_routes, fetch_windows
+from bootstrap import day_block_bootstrap
+from quantile_sketch import build_daily_sketches, filter_sketch_days, merge_sketches, sketch_quantiles
 
-# Load environment variables
-load_dotenv()
+# Line and band colors per window, in window order (the first two match the original two-window plots)
+WINDOW_COLORS = ['navy', 'blue', 'darkorange', 'green', 'purple', 'firebrick']
+WINDOW_FILL_COLORS = ['rgba(0, 0, 128, 0.2)', 'rgba(0, 0, 255, 0.2)', 'rgba(255, 140, 0, 0.2)',
+                      'rgba(0, 128, 0, 0.2)', 'rgba(128, 0, 128, 0.2)', 'rgba(178, 34, 34, 0.2)']
+
+TIMESERIES_API_URL = 'https://api.iteris-clearguide.com/v1/route/timeseries/'
 
 # Functions -----------------------------------------------------------------
 #-------------------------------------------------------------------------
+@traced()
 def parse_timeseries_json_response(response, route_id):
     data = []
     
@@ -36,68 +40,45 @@ def parse_timeseries_json_response(response, route_id):
     columns = ['route_id', 'timestamp', 'travel_time']
     return pd.DataFrame(data, columns=columns)
 
-def get_timeseries_data(route_ids, start_datetime, end_datetime, username, password):
+@traced()
+def get_timeseries_data(route_ids, start_datetime, end_datetime, username, password, granularity='5min', store=None, cancel_event=None):
     # Define the API parameters
-    API_URL = 'https://api.iteris-clearguide.com/v1/route/timeseries/'
+    API_URL = TIMESERIES_API_URL
     CUSTOMER_KEY = 'ut'
     ROUTE_ID_TYPE = 'customer_route_number'
-    # Use datetime strings directly (YYYY-MM-DD HH:MM:SS format)
-    START_TIMESTAMP = start_datetime.strftime("%Y-%m-%d %H:%M:%S")
-    END_TIMESTAMP = end_datetime.strftime("%Y-%m-%d %H:%M:%S")
     METRIC = 'avg_travel_time'
-    GRANULARITY = '5min'
     INCLUDE_HOLIDAYS = 'false'
 
-    cg_api_handler = ClearGuideApiHandler(username=username, password=password)
-    all_parsed_data = []  # Initialize empty list to store all route data
+    def fetch_route(cg_api_handler, route_id, start_timestamp, end_timestamp):
+        # Timestamps are UTC 'YYYY-MM-DD HH:MM:SS' strings
+        query = f'{API_URL}?customer_key={CUSTOMER_KEY}&route_id={route_id}&route_id_type={ROUTE_ID_TYPE}&s_timestamp={start_timestamp}&e_timestamp={end_timestamp}&metrics={METRIC}&holidays={INCLUDE_HOLIDAYS}&granularity={granularity}'
 
-    try:
-        for route_id in route_ids:
-            query = f'{API_URL}?customer_key={CUSTOMER_KEY}&route_id={route_id}&route_id_type={ROUTE_ID_TYPE}&s_timestamp={START_TIMESTAMP}&e_timestamp={END_TIMESTAMP}&metrics={METRIC}&holidays={INCLUDE_HOLIDAYS}&granularity={GRANULARITY}'
-            
-            response = cg_api_handler.call(url=query)
-            
-            if 'error' in response and response['error']:
-                raise Exception(f"Error fetching response for route_id {route_id}... Message: {response.get('msg', 'No message provided')}")
-            
-            # Parse JSON response and append to all_parsed_data
-            route_data = parse_timeseries_json_response(response, route_id)
-            all_parsed_data.append(route_data)
-            
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        raise
-
-    # Combine all route data into a single DataFrame
-    return pd.concat(all_parsed_data, ignore_index=True)
-
-def timeseries_comparison(route_ids, window1_start, window1_end, window2_start, window2_end, username, password):
-    # Convert both windows to datetime objects
-    local_tz = pytz.timezone('America/Denver')
-    windows = {
-        'window1': (
-            local_tz.localize(datetime.strptime(window1_start, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc),
-            local_tz.localize(datetime.strptime(window1_end, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc)
-        ),
-        'window2': (
-            local_tz.localize(datetime.strptime(window2_start, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc),
-            local_tz.localize(datetime.strptime(window2_end, "%Y-%m-%d %H:%M:%S")).astimezone(timezone.utc)
-        )
-    }
+        response = cg_api_handler.call(url=query)
+
+        if 'error' in response and response['error']:
+            raise Exception(f"Error fetching response for route_id {route_id}... Message: {response.get('msg', 'No message provided')}")
 
-    # Fetch data for both windows
-    data_window1 = get_timeseries_data(route_ids, windows['window1'][0], windows['window1'][1], username, password)
-    data_window2 = get_timeseries_data(route_ids, windows['window2'][0], windows['window2'][1], username, password)
+        # Parse JSON response
+        return parse_timeseries_json_response(response, route_id)
 
-    # Add period column to each dataset
-    data_window1['period'] = 'window1'
-    data_window2['period'] = 'window2'
+    # Authentication, the shared store and cancellation are handled the same way for every endpoint
+    return fetch_routes(API_URL, route_ids, start_datetime, end_datetime, username, password, granularity, fetch_route, store, cancel_event)
 
-    # Combine the datasets
-    combined_data = pd.concat([data_window1, data_window2], ignore_index=True)
-    return combined_data
+@traced()
+def timeseries_comparison(route_ids, windows, username, password, granularity='5min', store=None):
+    # windows maps each window name to its (start, end) local datetime strings, e.g.
+    # {'Before': ("2024-09-01 00:00:00", "2024-09-30 23:59:59"), 'After': (...)}
+    return fetch_windows(get_timeseries_data, route_ids, windows, username, password, granularity, store)
 
-def summary_table(combined_data, selected_days, excluded_dates):
+@traced()
+def summary_statistics(combined_data, selected_days, excluded_dates, baseline=None, n_bootstrap=2000, confidence=0.95, n_jobs=1):
+    # Long-format summary: one row per route and window with its mean and sample size, plus the
+    # change, percent change, p-value and day-block bootstrap confidence intervals against the
+    # baseline (empty on the baseline's own rows). n_bootstrap=0 skips the bootstrap.
+
+    # Windows in the order they were fetched; the first one is the baseline unless another is chosen
+    periods = list(dict.fromkeys(combined_data['period']))
+    baseline = baseline or periods[0]
 
     # Filter excluded dates
     combined_data['date'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%Y-%m-%d')
@@ -111,10 +92,73 @@ def summary_table(combined_data, selected_days, excluded_dates):
     summary = combined_data.groupby(['route_id', 'period'])['travel_time'].agg([
         ('mean', 'mean'),
         ('n', 'count')  # Add count to get sample size
-    ]).round(2)
-    
+    ]).reset_index()
+
+    # Keep the window order rather than alphabetical order
+    summary['period'] = pd.Categorical(summary['period'], categories=periods, ordered=True)
+    summary = summary.sort_values(['route_id', 'period']).reset_index(drop=True)
+    summary['period'] = summary['period'].astype(str)
+    summary.insert(2, 'baseline', baseline)
+
+    # Calculate the difference and percent change of every window against the baseline
+    baseline_mean = summary['route_id'].map(summary[summary['period'] == baseline].set_index('route_id')['mean'])
+    is_comparison = summary['period'] != baseline
+    summary['diff'] = (summary['mean'] - baseline_mean).where(is_comparison)
+    summary['pct_change'] = ((summary['diff'] / baseline_mean) * 100).where(is_comparison)
+
+    # Calculate p-values (scipy is slow to import, so it is only loaded once a summary is requested)
+    from scipy import stats
+
+    def calculate_pvalue(route_id, period):
+        baseline_data = combined_data[(combined_data['route_id'] == route_id) & 
+                                    (combined_data['period'] == baseline)]['travel_time']
+        period_data = combined_data[(combined_data['route_id'] == route_id) & 
+                                  (combined_data['period'] == period)]['travel_time']
+        _, p_value = stats.ttest_ind(baseline_data, period_data)
+        return p_value
+
+    summary['p_value'] = [
+        calculate_pvalue(route_id, period) if period != baseline else float('nan')
+        for route_id, period in zip(summary['route_id'], summary['period'])
+    ]
+
+    # The t-test treats every 5-minute sample as independent; resampling whole days does not.
+    # Fixed seed so the intervals do not move between reruns of the same analysis.
+    ci_columns = ['diff_ci_low', 'diff_ci_high', 'pct_change_ci_low', 'pct_change_ci_high']
+    if n_bootstrap:
+        intervals = day_block_bootstrap(combined_data, baseline, n_replicates=n_bootstrap, confidence=confidence, seed=0, n_jobs=n_jobs)
+        summary = summary.merge(intervals, on=['route_id', 'period'], how='left')
+    else:
+        summary = summary.assign(**{column: float('nan') for column in ci_columns})
+    summary['confidence'] = confidence
+
+    return summary
+
+@traced()
+def summary_table(combined_data, selected_days, excluded_dates, baseline=None, summary=None):
+
+    # Reuse a summary_statistics result when the caller already has one
+    if summary is None:
+        summary = summary_statistics(combined_data, selected_days, excluded_dates, baseline)
+    summary = summary.copy()
+    periods = list(dict.fromkeys(summary['period']))
+
+    # Rounded for display only; summary_statistics keeps the exact means for export
+    summary['mean'] = summary['mean'].round(2)
+    if summary.empty:
+        # The day filters left no data
+        return pd.DataFrame(columns=['Route ID'])
+    baseline = summary['baseline'].iloc[0]
+    comparisons = [period for period in periods if period != baseline]
+
+    # Format p-values and confidence intervals for display
+    summary['p_value'] = summary['p_value'].map(lambda p_value: f'{p_value:.4e}' if p_value < 0.0001 else f'{p_value:.4f}')
+    summary['diff_ci'] = [f'{low:.2f} to {high:.2f}' if pd.notna(low) else '' for low, high in zip(summary['diff_ci_low'], summary['diff_ci_high'])]
+    summary['pct_change_ci'] = [f'{low:.2f} to {high:.2f}' if pd.notna(low) else '' for low, high in zip(summary['pct_change_ci_low'], summary['pct_change_ci_high'])]
+    confidence_label = f"{summary['confidence'].iloc[0] * 100:g}% CI"
+
     # Pivot the table to have windows as columns
-    summary_pivoted = summary.unstack(level='period')
+    summary_pivoted = summary.set_index(['route_id', 'period'])[['mean', 'n', 'diff', 'pct_change', 'p_value', 'diff_ci', 'pct_change_ci']].unstack(level='period')
     
     # Flatten column names
     summary_pivoted.columns = [f'{col[1]}_{col[0]}' if isinstance(col, tuple) else col 
@@ -123,45 +167,31 @@ def summary_table(combined_data, selected_days, excluded_dates):
     # Reset index to make route_id a regular column
     summary_pivoted = summary_pivoted.reset_index()
 
-    # Calculate the difference and percent change
-    summary_pivoted['diff'] = summary_pivoted['window2_mean'] - summary_pivoted['window1_mean']
-    summary_pivoted['pct_change'] = (summary_pivoted['diff'] / summary_pivoted['window1_mean']) * 100
-
-    # Calculate p-values
-    def calculate_pvalue(route_id):
-        window1_data = combined_data[(combined_data['route_id'] == route_id) & 
-                                   (combined_data['period'] == 'window1')]['travel_time']
-        window2_data = combined_data[(combined_data['route_id'] == route_id) & 
-                                   (combined_data['period'] == 'window2')]['travel_time']
-        _, p_value = stats.ttest_ind(window1_data, window2_data)
-        return f'{p_value:.4e}' if p_value < 0.0001 else f'{p_value:.4f}'
-
-    # Add p-values to the summary table
-    summary_pivoted['p_value'] = summary_pivoted['route_id'].map(calculate_pvalue)
-
     # Create a mapping for prettier column names
-    column_mapping = {
-        'route_id': 'Route ID',
-        'window1_mean': 'Mean (Window 1)',
-        'window2_mean': 'Mean (Window 2)',
-        'diff': 'Change (Minutes)',
-        'pct_change': '% Change',
-        'p_value': 'P-Value',
-        'window1_n': 'Sample Size (Window 1)',
-        'window2_n': 'Sample Size (Window 2)',
-    }
-    
-    # Define the desired column order
-    column_order = ['route_id', 'window1_mean', 'window2_mean', 'diff', 'pct_change', 'p_value', 'window1_n', 'window2_n']
+    column_mapping = {'route_id': 'Route ID'}
+    for period in periods:
+        column_mapping[f'{period}_mean'] = f'Mean ({period})'
+    for period in comparisons:
+        column_mapping[f'{period}_diff'] = f'Change vs {baseline} ({period}, Minutes)'
+        column_mapping[f'{period}_pct_change'] = f'% Change vs {baseline} ({period})'
+        column_mapping[f'{period}_p_value'] = f'P-Value ({period})'
+        column_mapping[f'{period}_diff_ci'] = f'Change {confidence_label} ({period}, Minutes)'
+        column_mapping[f'{period}_pct_change_ci'] = f'% Change {confidence_label} ({period})'
+    for period in periods:
+        column_mapping[f'{period}_n'] = f'Sample Size ({period})'
     
     # Reorder and rename columns
+    column_order = list(column_mapping)
     summary_pivoted = summary_pivoted[column_order]
     summary_pivoted.columns = [column_mapping[col] for col in column_order]
 
     return summary_pivoted
 
+@traced()
 def build_timeseries_plot(combined_data, selected_days, excluded_dates):
 
+    periods = list(dict.fromkeys(combined_data['period']))
+
     # Filter excluded dates
     combined_data['date'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%Y-%m-%d')
     combined_data = combined_data[~combined_data['date'].isin(excluded_dates)]
@@ -172,32 +202,22 @@ def build_timeseries_plot(combined_data, selected_days, excluded_dates):
 
     fig = go.Figure()
     
-    # Add traces for each window
-    fig.add_trace(go.Scatter(
-        x=combined_data[combined_data['period'] == 'window1']['timestamp'],
-        y=combined_data[combined_data['period'] == 'window1']['travel_time'],
-        mode='markers',
-        name='Window 1',
-        marker=dict(color='navy', size=6)
-    ))
-    
-    fig.add_trace(go.Scatter(
-        x=combined_data[combined_data['period'] == 'window2']['timestamp'],
-        y=combined_data[combined_data['period'] == 'window2']['travel_time'],
-        mode='markers',
-        name='Window 2',
-        marker=dict(color='blue', size=6)
-    ))
-
-    # Calculate and add mean lines for each window
-    window1_mean = combined_data[combined_data['period'] == 'window1']['travel_time'].mean()
-    window2_mean = combined_data[combined_data['period'] == 'window2']['travel_time'].mean()
-
-    # Add horizontal mean lines
-    fig.add_hline(y=window1_mean, line_dash="dash", line_color="navy", 
-                 annotation_text=f"Window 1 Mean: {window1_mean:.2f}")
-    fig.add_hline(y=window2_mean, line_dash="dash", line_color="red", 
-                 annotation_text=f"Window 2 Mean: {window2_mean:.2f}")
+    # Add traces and a horizontal mean line for each window
+    for idx, period in enumerate(periods):
+        period_data = combined_data[combined_data['period'] == period]
+        color = WINDOW_COLORS[idx % len(WINDOW_COLORS)]
+
+        fig.add_trace(go.Scatter(
+            x=period_data['timestamp'],
+            y=period_data['travel_time'],
+            mode='markers',
+            name=period,
+            marker=dict(color=color, size=6)
+        ))
+
+        period_mean = period_data['travel_time'].mean()
+        fig.add_hline(y=period_mean, line_dash="dash", line_color=color, 
+                     annotation_text=f"{period} Mean: {period_mean:.2f}")
     
     # Update layout
     fig.update_layout(
@@ -211,33 +231,68 @@ def build_timeseries_plot(combined_data, selected_days, excluded_dates):
     return fig
 
 
-def process_time_of_day(combined_data, selected_days, excluded_dates):
-    # Filter excluded dates
-    combined_data['date'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%Y-%m-%d')
-    combined_data = combined_data[~combined_data['date'].isin(excluded_dates)]
-    # Filter selected_days
-    combined_data['day_name'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%A')
-    combined_data = combined_data[combined_data['day_name'].isin(selected_days)]
-
-    combined_data['day_of_week'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%w')
-    combined_data['time'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%H:%M')
-
-    # Group by route_id, period, NOT day_of_week, and time and create columns for min, avg, and max travel time 
-    data_grouped = combined_data.groupby(['route_id', 'period', 'time']).agg({
-        'travel_time': ['min', 'mean', 'max']
-    }).reset_index()
-    
-    # Flatten column names
-    data_grouped.columns = ['route_id', 'period', 'time', 'travel_time_min', 'travel_time_mean', 'travel_time_max']
+@traced()
+def process_time_of_day(combined_data, selected_days, excluded_dates, sketches=None, dense=None, profile=None):
+    # sketches: daily quantile sketches from build_daily_sketches, reused across day filters.
+    # Built from combined_data when not given.
+    # dense: a DenseTravelTimes (dense.py) covering combined_data; when given, min/mean/max come from
+    # its NaN-aware reductions instead of a groupby over the rows.
+    # profile: dense.time_of_day_profile(selected_days, excluded_dates) computed once by a caller that
+    # processes one route at a time; used in place of dense. Either way the results differ from the
+    # groupby in two ways: values carry float32 precision (about 7 significant digits), and on the day
+    # daylight saving ends the two readings in the repeated 01:00-01:55 hour are averaged into one slot
+    # before min and max are taken, so those times' min/max are not the raw extremes.
+    if sketches is None:
+        sketches = build_daily_sketches(combined_data)
+    else:
+        sketches = sketches[sketches['route_id'].isin(combined_data['route_id'].unique())
+                            & sketches['period'].isin(combined_data['period'].unique())]
+
+    if profile is None and dense is not None:
+        profile = dense.time_of_day_profile(selected_days, excluded_dates)
+
+    if profile is not None:
+        data_grouped = profile[profile['route_id'].isin(combined_data['route_id'].unique())
+                               & profile['period'].isin(combined_data['period'].unique())]
+        # Same row order as the groupby below
+        data_grouped = data_grouped.sort_values(['route_id', 'period', 'time']).reset_index(drop=True)
+    else:
+        # Filter excluded dates
+        combined_data['date'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%Y-%m-%d')
+        combined_data = combined_data[~combined_data['date'].isin(excluded_dates)]
+        # Filter selected_days
+        combined_data['day_name'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%A')
+        combined_data = combined_data[combined_data['day_name'].isin(selected_days)]
+
+        combined_data['day_of_week'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%w')
+        combined_data['time'] = pd.to_datetime(combined_data['timestamp']).dt.strftime('%H:%M')
+
+        # Group by route_id, period, NOT day_of_week, and time and create columns for min, avg, and max travel time 
+        data_grouped = combined_data.groupby(['route_id', 'period', 'time']).agg({
+            'travel_time': ['min', 'mean', 'max']
+        }).reset_index()
+
+        # Flatten column names
+        data_grouped.columns = ['route_id', 'period', 'time', 'travel_time_min', 'travel_time_mean', 'travel_time_max']
+
+    # Add p15/p50/p85 from the merged daily sketches for the same day filter
+    percentiles = sketch_quantiles(merge_sketches(filter_sketch_days(sketches, selected_days, excluded_dates)))
+    data_grouped = data_grouped.merge(percentiles, on=['route_id', 'period', 'time'], how='left')
 
     return data_grouped
 
 
-def build_time_of_day_plot(combined_data):
+@traced()
+def build_time_of_day_plot(combined_data, baseline=None):
     fig = go.Figure()
+
+    periods = list(dict.fromkeys(combined_data['period']))
+    baseline = baseline or periods[0]
     
-    # Create separate traces for Window 1 and Window 2
-    for period, color in [('window1', 'navy'), ('window2', 'blue')]:
+    # Create a trace for every window
+    for idx, period in enumerate(periods):
+        color = WINDOW_COLORS[idx % len(WINDOW_COLORS)]
+
         # Create an explicit copy of the filtered data
         period_data = combined_data[combined_data['period'] == period].copy()
         
@@ -245,7 +300,7 @@ def build_time_of_day_plot(combined_data):
         period_data['datetime'] = pd.to_datetime(period_data['time'], format='%H:%M')
         period_data = period_data.sort_values('datetime')
         
-        # Add the main line for both windows
+        # Add the main line for every window
         fig.add_trace(go.Scatter(
             x=period_data['time'],
             y=period_data['travel_time_mean'],
@@ -254,28 +309,37 @@ def build_time_of_day_plot(combined_data):
             mode='lines'
         ))
         
-        # Add min/max range only for Window 2
-        if period == 'window2':
+        # Add the 15th-85th percentile band and median only for the windows being compared against
+        # the baseline; unlike min/max, the band is not stretched by single incidents
+        if period != baseline:
+            fill_color = WINDOW_FILL_COLORS[idx % len(WINDOW_FILL_COLORS)]
             fig.add_trace(go.Scatter(
                 x=period_data['time'],
-                y=period_data['travel_time_max'],
-                name='Window 2 Range',
+                y=period_data['travel_time_p50'],
+                name=f'{period} Median',
+                line=dict(color=color, dash='dot'),
+                mode='lines'
+            ))
+            fig.add_trace(go.Scatter(
+                x=period_data['time'],
+                y=period_data['travel_time_p85'],
+                name=f'{period} 15th-85th Percentile',
                 mode='lines',
                 line=dict(width=0),
                 showlegend=True,
-                legendgroup='range',
-                fillcolor='rgba(0, 0, 255, 0.2)'
+                legendgroup=f'{period}_range',
+                fillcolor=fill_color
             ))
             fig.add_trace(go.Scatter(
                 x=period_data['time'],
-                y=period_data['travel_time_min'],
-                name='Window 2 Range',
+                y=period_data['travel_time_p15'],
+                name=f'{period} 15th-85th Percentile',
                 mode='lines',
                 line=dict(width=0),
-                fillcolor='rgba(0, 0, 255, 0.2)',
+                fillcolor=fill_color,
                 fill='tonexty',
                 showlegend=False,
-                legendgroup='range'
+                legendgroup=f'{period}_range'
             ))
     
     # Update layout
@@ -304,12 +368,15 @@ def build_time_of_day_plot(combined_data):
 # Example usage:
 
 
+# import config, os
+# config.init()
+
 # combined_data = timeseries_comparison(
 #     route_ids=[13236],
-#     window1_start="2024-09-01 00:00:00",
-#     window1_end="2024-09-30 23:59:59",
-#     window2_start="2024-10-01 00:00:00",
-#     window2_end="2024-10-31 23:59:59",
+#     windows={
+#         'Window 1': ("2024-09-01 00:00:00", "2024-09-30 23:59:59"),
+#         'Window 2': ("2024-10-01 00:00:00", "2024-10-31 23:59:59"),
+#     },
 #     username=os.getenv('CG_USERNAME'),
 #     password=os.getenv('CG_PASSWORD')
 # )
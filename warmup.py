@@ -0,0 +1,215 @@
+# Off-peak cache warm-up for registered corridors.
+# Reads a registry of routes, and during the off-peak window fetches every day in the lookback period
+# (up to yesterday) that is not yet in the on-disk day cache, using the same fetchers and cache as
+# app.py. Analysts opening the app the next morning then load those days from disk instead of waiting
+# on the API. Recent days that had not settled when last fetched are fetched again once their cached
+# copy is older than the cache's recent-day TTL.
+#
+# Usage:
+#   python warmup.py --registry corridors.json            # run nightly inside the off-peak window
+#   python warmup.py --registry corridors.json --once     # one pass now, then exit
+#
+# Credentials come from CG_USERNAME / CG_PASSWORD (environment or .env). The cache directory must be
+# the same CACHE_DIR the app uses, as should CACHE_SETTLE_DAYS, CACHE_RECENT_TTL_HOURS, CACHE_MAX_MB and
+# CACHE_MAX_AGE_DAYS.
+
+import argparse
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+import config
+from api.function import ApiError
+from data_store import SharedDataStore, day_cache_from_env
+from fetch_planner import LOCAL_TZ, to_utc
+from instrumentation import configure_logging
+from speed_contours import SPEED_CONTOURS_API_URL, get_speed_data
+from timeseries import TIMESERIES_API_URL, get_timeseries_data
+
+logger = logging.getLogger('travel_times.warmup')
+
+# Endpoint name used in the registry -> (fetcher, API URL used in cache keys, default granularities)
+ENDPOINTS = {
+    'timeseries': (get_timeseries_data, TIMESERIES_API_URL, ['5min', 'hour']),
+    'speed_contours': (get_speed_data, SPEED_CONTOURS_API_URL, ['hour']),
+}
+
+DEFAULT_LOOKBACK_DAYS = 35
+
+# Longest run of missing days fetched in one request
+MAX_DAYS_PER_REQUEST = 31
+
+# Backoff on 429 and 5xx responses: retries per request, and the first delay in seconds (doubled on
+# every retry and capped at MAX_BACKOFF_SECONDS) when the response has no Retry-After
+MAX_RETRIES = 4
+BACKOFF_SECONDS = 30.0
+MAX_BACKOFF_SECONDS = 15 * 60
+
+# The pass stops after this many requests in a row fail even after backing off
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+class RateLimiter:
+    # Spaces successive API requests at least min_interval seconds apart, and counts them
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.requests = 0
+        self._last = 0.0
+
+    def wait(self):
+        delay = self._last + self.min_interval - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self._last = time.monotonic()
+        self.requests += 1
+
+
+# Functions -----------------------------------------------------------------
+#-------------------------------------------------------------------------
+def load_registry(path):
+    # {"lookback_days": 35,
+    #  "corridors": [{"name": "State Street", "route_ids": [13236, 13237]}],
+    #  "endpoints": {"timeseries": ["5min", "hour"], "speed_contours": ["hour"]}}
+    with open(path) as registry_file:
+        registry = json.load(registry_file)
+    route_ids = sorted({int(route_id) for corridor in registry['corridors'] for route_id in corridor['route_ids']})
+    endpoints = registry.get('endpoints', {name: endpoint[2] for name, endpoint in ENDPOINTS.items()})
+    return route_ids, endpoints, int(registry.get('lookback_days', DEFAULT_LOOKBACK_DAYS))
+
+def parse_off_peak(window):
+    # "01:00-05:00" -> (01:00, 05:00); the window may wrap past midnight, e.g. "22:00-04:00"
+    start, end = window.split('-')
+    return datetime.strptime(start, '%H:%M').time(), datetime.strptime(end, '%H:%M').time()
+
+def in_off_peak(off_peak, now=None):
+    now = (now or datetime.now(LOCAL_TZ)).time()
+    start, end = off_peak
+    return start <= now < end if start <= end else now >= start or now < end
+
+def missing_day_runs(day_cache, endpoint, granularity, route_id, days):
+    # Consecutive runs of days not yet cached (or cached before they settled and since expired), each
+    # at most MAX_DAYS_PER_REQUEST long
+    runs = []
+    for day in days:
+        if day_cache.has_day(endpoint, granularity, route_id, str(day)):
+            continue
+        if runs and (day - runs[-1][-1]).days == 1 and len(runs[-1]) < MAX_DAYS_PER_REQUEST:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    return runs
+
+def fetch_with_backoff(fetch, rate_limiter, max_retries=MAX_RETRIES, backoff_seconds=BACKOFF_SECONDS):
+    # Run fetch(), retrying rate-limited (429) and server-error (5xx) responses with exponential
+    # backoff, honouring Retry-After when the API sends one
+    for attempt in range(max_retries + 1):
+        rate_limiter.wait()
+        try:
+            return fetch()
+        except ApiError as e:
+            if not e.retryable or attempt == max_retries:
+                raise
+            delay = e.retry_after if e.retry_after is not None else min(backoff_seconds * 2 ** attempt, MAX_BACKOFF_SECONDS)
+            logger.warning(json.dumps({
+                'event': 'warmup_backoff', 'status_code': e.status_code, 'attempt': attempt + 1, 'delay_s': delay,
+            }))
+            time.sleep(delay)
+
+def warm_up(store, route_ids, endpoints, lookback_days, username, password, rate_limiter, off_peak=None,
+            max_retries=MAX_RETRIES, backoff_seconds=BACKOFF_SECONDS, max_consecutive_failures=MAX_CONSECUTIVE_FAILURES):
+    # One pass over every route, endpoint and granularity. Returns the number of API requests made.
+    # Stops early if the off-peak window closes, or if requests keep failing after backing off (the API
+    # is down or rate limiting hard); the remaining days are picked up on the next pass.
+    yesterday = datetime.now(LOCAL_TZ).date() - timedelta(days=1)
+    days = [yesterday - timedelta(days=offset) for offset in reversed(range(lookback_days))]
+    requests_at_start = rate_limiter.requests
+    consecutive_failures = 0
+
+    for endpoint_name, granularities in endpoints.items():
+        get_data, endpoint, _ = ENDPOINTS[endpoint_name]
+        for granularity in granularities:
+            for route_id in route_ids:
+                for run in missing_day_runs(store.day_cache, endpoint, granularity, route_id, days):
+                    if off_peak and not in_off_peak(off_peak):
+                        logger.info(json.dumps({'event': 'warmup_paused', 'reason': 'off-peak window closed'}))
+                        return rate_limiter.requests - requests_at_start
+
+                    start_utc = to_utc(f'{run[0]} 00:00:00')
+                    end_utc = to_utc(f'{run[-1]} 23:59:59')
+                    try:
+                        # The store saves each completed day to the day cache as it lands
+                        data = fetch_with_backoff(
+                            lambda: get_data([route_id], start_utc, end_utc, username, password, granularity, store),
+                            rate_limiter, max_retries, backoff_seconds
+                        )
+                    except Exception as e:
+                        consecutive_failures += 1
+                        logger.warning(json.dumps({
+                            'event': 'warmup_failed', 'endpoint': endpoint_name, 'granularity': granularity,
+                            'route_id': route_id, 'start': str(run[0]), 'end': str(run[-1]), 'error': str(e),
+                        }))
+                        if consecutive_failures >= max_consecutive_failures:
+                            logger.warning(json.dumps({
+                                'event': 'warmup_aborted', 'reason': f'{consecutive_failures} requests in a row failed',
+                            }))
+                            return rate_limiter.requests - requests_at_start
+                        continue
+                    consecutive_failures = 0
+                    logger.info(json.dumps({
+                        'event': 'warmup_fetched', 'endpoint': endpoint_name, 'granularity': granularity,
+                        'route_id': route_id, 'start': str(run[0]), 'end': str(run[-1]), 'rows': len(data),
+                    }))
+    return rate_limiter.requests - requests_at_start
+
+def main():
+    parser = argparse.ArgumentParser(description='Prefetch recent days for registered corridors into the day cache.')
+    parser.add_argument('--registry', required=True, help='JSON registry of corridors (see load_registry)')
+    parser.add_argument('--cache-dir', help='Day cache directory (default: CACHE_DIR or .cache/clearguide)')
+    parser.add_argument('--off-peak', default='01:00-05:00', help='Local time window to fetch in, HH:MM-HH:MM')
+    parser.add_argument('--min-interval', type=float, default=2.0, help='Minimum seconds between API requests')
+    parser.add_argument('--max-retries', type=int, default=MAX_RETRIES, help='Retries per request on 429 and 5xx responses')
+    parser.add_argument('--backoff-seconds', type=float, default=BACKOFF_SECONDS, help='First backoff delay when there is no Retry-After; doubles per retry')
+    parser.add_argument('--max-failures', type=int, default=MAX_CONSECUTIVE_FAILURES, help='Stop the pass after this many requests in a row fail')
+    parser.add_argument('--poll-minutes', type=float, default=10.0, help='How often to check for the off-peak window')
+    parser.add_argument('--once', action='store_true', help='Run one pass immediately and exit')
+    args = parser.parse_args()
+
+    config.init()
+    configure_logging()
+
+    username, password = os.getenv('CG_USERNAME'), os.getenv('CG_PASSWORD')
+    if not username or not password:
+        parser.error('CG_USERNAME and CG_PASSWORD must be set')
+
+    # Nothing needs to stay in memory between passes; the day cache is the product. Its settle lag and
+    # recent-day TTL and size and age limits come from the same CACHE_* variables the app uses.
+    store = SharedDataStore(max_bytes=0, day_cache=day_cache_from_env(args.cache_dir))
+    rate_limiter = RateLimiter(args.min_interval)
+    off_peak = parse_off_peak(args.off_peak)
+
+    last_pass_date = None
+    while True:
+        # Re-read the registry every pass so corridors can be added without a restart
+        route_ids, endpoints, lookback_days = load_registry(args.registry)
+        today = datetime.now(LOCAL_TZ).date()
+        if args.once or (in_off_peak(off_peak) and last_pass_date != today):
+            requests_made = warm_up(
+                store, route_ids, endpoints, lookback_days, username, password, rate_limiter,
+                off_peak=None if args.once else off_peak,
+                max_retries=args.max_retries,
+                backoff_seconds=args.backoff_seconds,
+                max_consecutive_failures=args.max_failures
+            )
+            deleted = store.day_cache.prune()
+            logger.info(json.dumps({'event': 'warmup_pass_complete', 'requests': requests_made, 'pruned_files': deleted}))
+            if args.once:
+                break
+            if in_off_peak(off_peak):
+                last_pass_date = today
+        time.sleep(args.poll_minutes * 60)
+
+
+if __name__ == '__main__':
+    main()